@@ -7,72 +7,298 @@ Tool to search for file duplicates, based on file size and content hash/digest
 # TODO: add option to exclude paths/patterns from recursive directory exploring
 # TODO: show progress bar?
 # TODO: add option to only compare filesize (not content hash)
-# TODO: add option to control the size of the content to hash
 # TODO: add logging/verbosity
 
+import collections
+import concurrent.futures
+import csv
+import ctypes
+import ctypes.util
+import errno
+import functools
+import gzip
 import hashlib
+import heapq
+import itertools
+import json
 import os
 import argparse
+import select
+import socket
+import sqlite3
+import stat
+import struct
+import sys
+import tempfile
+import time
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+HEAD_BLOCK_SIZE = 4 * 1024
+TAIL_BLOCK_SIZE = 4 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+ALGORITHMS = ['md5', 'sha1', 'sha256', 'blake2b']
+if xxhash is not None:
+    ALGORITHMS += ['xxh64', 'xxh3_64', 'xxh3_128']
 
 
 def main():
     # Handle command line interface
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("path", nargs="*")
+    arg_parser.add_argument(
+        "-a", "--algorithm", choices=ALGORITHMS, default="md5",
+        help="Hash algorithm for content digests (default: md5)."
+    )
+    arg_parser.add_argument(
+        "-f", "--format", choices=["text", "jsonl", "csv"], default="text",
+        help="Report format. Duplicate groups are written as soon as they are confirmed,"
+             " largest file size first."
+    )
+    arg_parser.add_argument(
+        "-d", "--directories", action="store_true", default=False,
+        help="Also detect duplicate directory trees: report the highest level identical directories"
+             " and leave out the files inside them from the file duplicates."
+    )
+    arg_parser.add_argument(
+        "--memory-budget", metavar="MB", type=int, default=None,
+        help="Keep the file size index within (approximately) this amount of memory,"
+             " by spilling sorted runs to temporary files (for very large trees)."
+    )
+    arg_parser.add_argument(
+        "--dedupe", action="store_true", default=False,
+        help="Reclaim the space of confirmed duplicates: share data extents with the first file of each group"
+             " (FIDEDUPERANGE, e.g. on Btrfs or XFS) or, where not supported,"
+             " atomically replace duplicates with hard links to the first file."
+    )
+    arg_parser.add_argument(
+        "--dry-run", action="store_true", default=False,
+        help="With --dedupe: only show what would be deduplicated."
+    )
+    arg_parser.add_argument(
+        "--emit-index", metavar="PATH", default=None,
+        help="Instead of reporting duplicates, write an index of all scanned files"
+             " (size, partial digest, full digest, path) to be merged with --merge (gzipped if PATH ends with .gz)."
+    )
+    arg_parser.add_argument(
+        "--merge", action="store_true", default=False,
+        help="Merge index files (given as paths), e.g. from multiple nodes, and report duplicates across them."
+    )
+    arg_parser.add_argument(
+        "--node", default=socket.gethostname(),
+        help="Node name to record in emitted index (default: host name)."
+    )
+    arg_parser.add_argument(
+        "--watch", action="store_true", default=False,
+        help="Keep running and watch the given directories (with inotify):"
+             " report each new or changed file that duplicates an existing one."
+    )
+    arg_parser.add_argument(
+        "--benchmark", action="store_true", default=False,
+        help="Measure the throughput of each available hash algorithm and exit."
+    )
+    arg_parser.add_argument(
+        "--cache", metavar="PATH", default=None,
+        help="SQLite file to cache content digests in between runs."
+    )
+    arg_parser.add_argument(
+        "--cache-max-age", metavar="DAYS", type=float, default=30,
+        help="Evict cache entries that were not used in the last DAYS days"
+             " (0: only keep the entries used in this run)."
+    )
+    arg_parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=1,
+        help="Number of parallel hashing workers."
+    )
+    arg_parser.add_argument(
+        "--compare-threshold", metavar="N", type=int, default=3,
+        help="Compare groups of at most N same sized files byte by byte instead of hashing them"
+             " (0 to always hash, ignored with --cache)."
+    )
+    arg_parser.add_argument(
+        "--processes", action="store_true", default=False,
+        help="Use worker processes instead of threads for parallel hashing."
+    )
 
     arguments = arg_parser.parse_args()
+    if arguments.directories and arguments.memory_budget:
+        arg_parser.error("--directories can not be combined with --memory-budget")
+    if arguments.merge and (arguments.directories or arguments.dedupe or arguments.emit_index):
+        arg_parser.error("--merge can not be combined with --directories, --dedupe or --emit-index")
+    if arguments.emit_index and (arguments.directories or arguments.dedupe):
+        arg_parser.error("--emit-index can not be combined with --directories or --dedupe")
+    if arguments.watch and (arguments.merge or arguments.directories or arguments.emit_index or arguments.dedupe):
+        arg_parser.error("--watch can not be combined with --merge, --directories, --emit-index or --dedupe")
+
+    if arguments.benchmark:
+        for algorithm, throughput in benchmark_algorithms():
+            print('{algorithm:>10s}: {throughput:8.1f} MB/s'.format(algorithm=algorithm, throughput=throughput))
+        return
+
+    if arguments.merge:
+        algorithm = read_index_header(arguments.path[0])['algorithm'] if arguments.path else arguments.algorithm
+        report = REPORT_WRITERS[arguments.format](algorithm=algorithm)
+        for size, hash, group in merge_indexes(arguments.path, node=arguments.node):
+            report.write_group(size, hash, group)
+        report.close()
+        return
 
     # Determine which files to compare
     if len(arguments.path) < 1:
-        seeds = '.'
+        seeds = ['.']
     else:
         seeds = arguments.path
-    file_list = get_file_list(seeds)
 
-    # Phase 1: group on file size and keep only real groups (two items or more)
-    size_groups = group_on_filesize(file_list)
-    size_groups = remove_small_groups(size_groups, minimum_size=2)
+    if arguments.watch:
+        cache = DigestCache(arguments.cache, max_age=arguments.cache_max_age * 86400) if arguments.cache else None
+        report = REPORT_WRITERS[arguments.format](algorithm=arguments.algorithm)
+        try:
+            watch_duplicates(seeds, report, algorithm=arguments.algorithm, cache=cache)
+        except KeyboardInterrupt:
+            pass
+        report.close()
+        if cache is not None:
+            cache.close()
+        return
 
-    # Phase 2: also check file contents in each group
-    content_groups = {}
-    for size, group in size_groups.items():
-        subgroups = group_on_content_hash(group)
-        subgroups = remove_small_groups(subgroups, minimum_size=2)
-        for hash, subgroup in subgroups.items():
-            content_groups[(size, hash)] = subgroup
+    if arguments.directories:
+        seeds = [os.path.normpath(seed) for seed in seeds]
+        file_entries = list(scan_files(seeds))
+    else:
+        file_entries = scan_files(seeds)
 
-    # Report
-    if len(content_groups) > 0:
-        print("Found these possible duplicates:")
-        for (size, hash), group in content_groups.items():
-            print('--- size: {size} B, content hash: {hash} ---'.format(size=size, hash=hash))
-            for file in group:
-                print(file)
+    cache = DigestCache(arguments.cache, max_age=arguments.cache_max_age * 86400) if arguments.cache else None
+    executor = None
+    if arguments.jobs > 1:
+        if arguments.processes:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=arguments.jobs)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=arguments.jobs)
+    max_in_flight = 4 * arguments.jobs
+
+    # Phase 1: group on file size
+    if arguments.memory_budget:
+        size_index = ExternalSizeIndex(memory_budget=arguments.memory_budget * 1024 * 1024)
+        for entry in file_entries:
+            size_index.add(entry)
+        size_groups = size_index.iter_size_groups()
     else:
-        print('No duplicates found')
+        size_index = None
+        size_groups = sort_size_groups(group_on_filesize(file_entries))
+    size_groups = ((size, collapse_hard_links(group)) for size, group in size_groups)
+
+    if arguments.emit_index:
+        with open_index(arguments.emit_index, 'wt') as f:
+            write_index(
+                size_groups, f, node=arguments.node, algorithm=arguments.algorithm,
+                cache=cache, executor=executor, max_in_flight=max_in_flight, batch_size=4 * max_in_flight
+            )
+    else:
+        # Phase 2: keep only real groups (two items or more) and also check file contents in each group
+        size_groups = ((size, group) for size, group in size_groups if len(group) >= 2)
+        find_and_report(arguments, seeds, file_entries, size_groups, cache, executor, max_in_flight)
+
+    if executor is not None:
+        executor.shutdown()
+    if cache is not None:
+        cache.close()
+    if size_index is not None:
+        size_index.close()
 
 
-def get_file_list(seeds):
+def find_and_report(arguments, seeds, file_entries, size_groups, cache, executor, max_in_flight):
     """
-    Build file list based on given seeds: file names
-    directory names (which will be explored recursively)
+    Find duplicates in given size groups and report them (according to command line arguments).
+    """
+    content_groups = iter_content_groups(
+        size_groups, algorithm=arguments.algorithm, cache=cache, executor=executor,
+        max_in_flight=max_in_flight, compare_threshold=arguments.compare_threshold,
+        batch_size=4 * max_in_flight,
+    )
 
-    @param seeds list of files or directories
+    # Phase 3 (optional): reclaim space of the duplicates
+    if arguments.dedupe:
+        deduplicator = Deduplicator(dry_run=arguments.dry_run)
+        content_groups = deduplicator.iter_deduplicated(content_groups)
+
+    # Report
+    report = REPORT_WRITERS[arguments.format](algorithm=arguments.algorithm)
+    if arguments.directories:
+        content_groups = list(content_groups)
+        directory_groups = find_duplicate_directories(
+            file_entries, [seed for seed in seeds if os.path.isdir(seed)], content_groups,
+            algorithm=arguments.algorithm
+        )
+        for size, hash, paths in directory_groups:
+            report.write_directory_group(size, hash, paths)
+        content_groups = exclude_directories(content_groups, set(p for g in directory_groups for p in g[2]))
+    for size, hash, group in content_groups:
+        report.write_group(size, hash, group)
+    report.close()
+    if arguments.dedupe:
+        deduplicator.write_summary()
+
+
+class FileEntry(collections.namedtuple('FileEntry', ['path', 'size', 'dev', 'ino', 'mtime_ns'])):
     """
+    File path with the stat info needed to compare and cache it.
+    """
+
+    @classmethod
+    def from_stat(cls, path, st):
+        return cls(path, st.st_size, st.st_dev, st.st_ino, st.st_mtime_ns)
+
+
+def get_file_entry(path):
+    """
+    Build FileEntry for given file path.
+    """
+    return FileEntry.from_stat(path, os.stat(path))
+
+
+def scan_files(seeds):
+    """
+    Generator of FileEntry items for all regular files, based on given seeds:
+    file names and directory names (which will be explored recursively).
 
-    file_list = []
+    Directories are explored with a single os.scandir pass per directory,
+    without following symbolic links and skipping special files.
+
+    @param seeds list of files or directories
+    """
     for seed in seeds:
         if os.path.isfile(seed):
             # just add files
-            file_list.append(seed)
+            yield get_file_entry(seed)
         elif os.path.isdir(seed):
-            # Recursively explore directories
-            for (dirpath, dirnames, filenames) in os.walk(seed):
-                for filename in filenames:
-                    file_list.append(os.path.join(dirpath, filename))
+            # Recursively explore directories (depth first, like os.walk).
+            stack = [seed]
+            while stack:
+                dirpath = stack.pop()
+                subdirs = []
+                try:
+                    with os.scandir(dirpath) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                try:
+                                    st = entry.stat(follow_symlinks=False)
+                                except OSError:
+                                    continue
+                                if stat.S_ISREG(st.st_mode):
+                                    yield FileEntry.from_stat(entry.path, st)
+                except OSError:
+                    # Unreadable directory: skip it (like os.walk does).
+                    continue
+                stack.extend(reversed(subdirs))
         else:
             raise RuntimeError('Could not find file/directory "{0}"'.format(seed))
-    return file_list
 
 
 def remove_small_groups(d, minimum_size=2):
@@ -91,46 +317,1313 @@ def remove_small_groups(d, minimum_size=2):
     return d2
 
 
-def group_on_filesize(filenames):
+def group_on_filesize(entries):
     """
     Group a list of files on file size.
 
-    @param filenames list of file paths
+    @param entries list of FileEntry items
 
     @return dictionary mapping file size to list of files with that file size
     """
     map = {}
-    for f in filenames:
-        size = os.path.getsize(f)
-        map[size] = map.get(size, []) + [f]
+    for entry in entries:
+        map.setdefault(entry.size, []).append(entry)
     return map
 
 
-def group_on_content_hash(filenames):
+def group_on(items, key_function):
     """
-    Group a list of files on a hash/digest of their content (MD5)
+    Group a list of items on the result of a key function.
 
-    @param filenames list of file paths
+    @param items list of items
+    @param key_function function that takes an item
 
-    @return dictionary mapping hash to list of files with that hash
+    @return dictionary mapping key to list of items with that key
     """
     map = {}
-    for f in filenames:
-        md5 = md5hash(f)
-        map[md5] = map.get(md5, []) + [f]
+    for item in items:
+        map.setdefault(key_function(item), []).append(item)
     return map
 
 
-def md5hash(filename, size=5000):
+def sort_size_groups(size_groups):
+    """
+    Get the items of a size group dictionary, largest file size first.
+
+    @param size_groups dictionary mapping file size to list of files
+
+    @return list of (size, list of files) tuples
+    """
+    return sorted(size_groups.items(), key=lambda item: item[0], reverse=True)
+
+
+class ExternalSizeIndex(object):
     """
-    Helper function to calculate MD5 hash of the file contents
-    (up to a given number of bytes).
+    Index of FileEntry items to group on file size, with bounded memory usage:
+    when the in-memory buffer exceeds the memory budget, it is sorted and
+    spilled as a run to a temporary file. Size groups are streamed
+    from a merge of all runs.
+    """
+
+    RECORD = struct.Struct('<QQQqI')
+    # Rough estimate of the memory footprint of a buffered FileEntry (besides its path).
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, memory_budget=256 * 1024 * 1024, tempdir=None):
+        self.memory_budget = memory_budget
+        self.tempdir = tempdir
+        self._buffer = []
+        self._buffer_size = 0
+        self._runs = []
+
+    def add(self, entry):
+        self._buffer.append(entry)
+        self._buffer_size += self.ENTRY_OVERHEAD + len(entry.path)
+        if self._buffer_size >= self.memory_budget:
+            self._spill()
+
+    def _sort_buffer(self):
+        # Largest first (stable sort, so original order is kept within a size).
+        self._buffer.sort(key=lambda e: e.size, reverse=True)
+
+    def _spill(self):
+        self._sort_buffer()
+        run = tempfile.TemporaryFile(dir=self.tempdir)
+        for entry in self._buffer:
+            path = os.fsencode(entry.path)
+            run.write(self.RECORD.pack(entry.size, entry.dev, entry.ino, entry.mtime_ns, len(path)))
+            run.write(path)
+        run.seek(0)
+        self._runs.append(run)
+        self._buffer = []
+        self._buffer_size = 0
+
+    def _read_run(self, run):
+        while True:
+            header = run.read(self.RECORD.size)
+            if not header:
+                break
+            size, dev, ino, mtime_ns, path_length = self.RECORD.unpack(header)
+            path = os.fsdecode(run.read(path_length))
+            yield FileEntry(path, size, dev, ino, mtime_ns)
+
+    def iter_size_groups(self):
+        """
+        Generator of (size, list of FileEntry items) tuples, largest file size first.
+        """
+        self._sort_buffer()
+        streams = [self._read_run(run) for run in self._runs] + [iter(self._buffer)]
+        merged = heapq.merge(*streams, key=lambda e: -e.size)
+        for size, group in itertools.groupby(merged, key=lambda e: e.size):
+            yield size, list(group)
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._buffer = []
+
+
+def collapse_hard_links(entries):
+    """
+    Only keep the first entry of each set of hard links to the same inode.
+
+    @param entries list of FileEntry items
+
+    @return list of FileEntry items
+    """
+    seen = set()
+    result = []
+    for entry in entries:
+        key = (entry.dev, entry.ino)
+        if key not in seen:
+            seen.add(key)
+            result.append(entry)
+    return result
+
+
+def iter_content_groups(size_groups, batch_size=64, **kwargs):
+    """
+    Generator of confirmed duplicate groups, processing the size groups
+    in batches (in given order), so that results can be
+    reported while the scan is still running.
+
+    @param size_groups iterable of (size, list of FileEntry items) tuples,
+        largest file size first
+    @param batch_size (minimum) number of files to process per batch
+    @param kwargs additional arguments for group_on_content
+
+    @return generator of (size, full content hash, list of files) tuples
+    """
+    def process(batch):
+        content_groups = group_on_content(batch, **kwargs)
+        return sorted(content_groups, key=lambda g: g[0], reverse=True)
+
+    batch = {}
+    batch_files = 0
+    for size, files in size_groups:
+        batch[size] = files
+        batch_files += len(files)
+        if batch_files >= batch_size:
+            for content_group in process(batch):
+                yield content_group
+            batch = {}
+            batch_files = 0
+    if batch:
+        for content_group in process(batch):
+            yield content_group
+
+
+def find_duplicate_directories(entries, roots, content_groups, algorithm='md5'):
+    """
+    Find identical directory trees, based on Merkle-style tree digests
+    that combine the names and contents of files and subdirectories bottom-up.
+
+    Directories are first compared on a signature of names and file sizes only,
+    so that tree digests are only built for directories that might have a duplicate.
+    File contents are compared based on the given duplicate groups
+    (files not in any group are considered unique).
+
+    @param entries list of all FileEntry items
+    @param roots list of root directories that were scanned
+    @param content_groups list of (size, hash, list of files) duplicate groups
+    @param algorithm name of the hash algorithm
+
+    @return list of (total size, tree hash, list of directory paths) tuples
+        of the highest level duplicate directories, largest first
+    """
+    # Build directory tree.
+    roots = set(roots)
+    files = collections.defaultdict(list)
+    subdirs = collections.defaultdict(list)
+    directories = set(roots)
+    for entry in entries:
+        chain = [os.path.dirname(entry.path)]
+        while chain[-1] not in roots and chain[-1] not in directories:
+            parent = os.path.dirname(chain[-1])
+            if parent == chain[-1]:
+                # Not inside a scanned directory.
+                chain = None
+                break
+            chain.append(parent)
+        if chain is None:
+            continue
+        files[chain[0]].append(entry)
+        for child, parent in zip(chain[:-1], chain[1:]):
+            directories.add(child)
+            subdirs[parent].append(child)
+    # Deepest directories first.
+    directories = sorted(directories, key=lambda d: d.count(os.sep), reverse=True)
+
+    def tree_digest(directory, file_key, subdir_digests):
+        items = [(os.path.basename(f.path), 'f', file_key(f)) for f in files[directory]]
+        items += [(os.path.basename(d), 'd', subdir_digests[d]) for d in subdirs[directory]]
+        h = new_hash(algorithm)
+        h.update(repr(sorted(items)).encode('utf-8', 'surrogateescape'))
+        return h.hexdigest()
+
+    # Phase 1: cheap signature on names and sizes.
+    total_sizes = {}
+    size_signatures = {}
+    for d in directories:
+        total_sizes[d] = sum(f.size for f in files[d]) + sum(total_sizes[s] for s in subdirs[d])
+        size_signatures[d] = tree_digest(d, lambda f: f.size, size_signatures)
+    candidates = group_on(
+        [d for d in directories if files[d] or subdirs[d]], lambda d: size_signatures[d]
+    )
+    candidates = set(d for group in remove_small_groups(candidates, minimum_size=2).values() for d in group)
+
+    # Phase 2: tree digests based on file contents (only for candidates).
+    content_classes = {}
+    for size, hash, group in content_groups:
+        for f in group:
+            content_classes[(f.dev, f.ino)] = (size, hash, group[0].path)
+    tree_digests = {}
+    for d in directories:
+        if d in candidates:
+            tree_digests[d] = tree_digest(
+                d, lambda f: content_classes.get((f.dev, f.ino), (f.dev, f.ino)), tree_digests
+            )
+    duplicates = remove_small_groups(group_on(candidates, lambda d: tree_digests[d]), minimum_size=2)
+
+    # Only keep highest level duplicates.
+    matched = set(d for group in duplicates.values() for d in group)
+    result = []
+    for hash, group in duplicates.items():
+        if any(os.path.dirname(d) not in matched for d in group):
+            result.append((total_sizes[group[0]], hash, sorted(group)))
+    result.sort(key=lambda g: (-g[0], g[2]))
+    return result
+
+
+def exclude_directories(content_groups, directories):
+    """
+    Generator of duplicate groups, leaving out files inside given directories
+    (but keeping one of them as reference for files elsewhere).
+
+    @param content_groups list of (size, hash, list of files) duplicate groups
+    @param directories set of directory paths
+
+    @return generator of (size, hash, list of files) duplicate groups
+    """
+    def inside(path):
+        parent = os.path.dirname(path)
+        while parent not in directories:
+            if os.path.dirname(parent) == parent:
+                return False
+            parent = os.path.dirname(parent)
+        return True
+
+    for size, hash, group in content_groups:
+        outside = [f for f in group if not inside(f.path)]
+        if len(outside) == 0:
+            continue
+        if len(outside) < 2:
+            outside = [f for f in group if f not in outside][:1] + outside
+        if len(outside) >= 2:
+            yield size, hash, outside
+
+
+def group_on_content_hash(entries, size=None, algorithm='md5', cache=None, executor=None, max_in_flight=16):
+    """
+    Group a list of files on a hash/digest of their content.
+
+    @param entries list of FileEntry items
+    @param size common file size of the given files (if known)
+    @param algorithm name of the hash algorithm
+    @param cache optional DigestCache to look up/store digests
+    @param executor optional concurrent.futures executor to hash in parallel
+    @param max_in_flight maximum number of files submitted to the executor at once
+
+    @return dictionary mapping full content hash to list of files with that hash
+    """
+    groups = group_on_content(
+        {size: entries}, algorithm=algorithm, cache=cache, executor=executor, max_in_flight=max_in_flight
+    )
+    return dict((hash, group) for size, hash, group in groups)
+
+
+def group_on_content(
+        size_groups, algorithm='md5', cache=None, executor=None, max_in_flight=16, compare_threshold=0
+):
+    """
+    Split groups of same sized files further on their content.
+
+    Small groups (up to the compare threshold) are compared byte by byte,
+    unless a cache is given: byte comparison does not produce digests to cache,
+    so all groups are hashed then, and a next run does not have to read unchanged files again.
+    Other groups are hashed in stages of increasing cost (head block, tail block,
+    full content), where each stage only handles the files that still
+    have a possible duplicate after the previous stage.
+    The files of all groups are hashed together per stage,
+    so that an executor can work across group boundaries.
+
+    @param size_groups dictionary mapping file size to list of FileEntry items
+    @param algorithm name of the hash algorithm
+    @param cache optional DigestCache to look up/store digests
+    @param executor optional concurrent.futures executor to hash in parallel
+    @param max_in_flight maximum number of files submitted to the executor at once
+    @param compare_threshold maximum group size to compare byte by byte instead of hashing
+
+    @return list of (size, full content hash, list of files) tuples
+        (hash is None for groups that were compared byte by byte)
+    """
+    content_groups = []
+    if cache is not None:
+        compare_threshold = 0
+
+    small_groups = [(size, files) for size, files in size_groups.items() if len(files) <= compare_threshold]
+    compared = bounded_map(
+        [(compare_contents, [f.path for f in files]) for size, files in small_groups],
+        executor=executor, max_in_flight=max_in_flight
+    )
+    for (size, files), identical in zip(small_groups, compared):
+        entries = dict((f.path, f) for f in files)
+        for paths in identical:
+            content_groups.append((size, None, [entries[p] for p in paths]))
+
+    groups = [
+        (size, get_hash_stages(size), files)
+        for size, files in size_groups.items() if len(files) > compare_threshold
+    ]
+    while groups:
+        tasks = [(stages[0], f) for size, stages, files in groups for f in files]
+        digests = compute_digests(tasks, algorithm=algorithm, cache=cache, executor=executor, max_in_flight=max_in_flight)
+        next_groups = []
+        for size, stages, files in groups:
+            subgroups = {}
+            for f in files:
+                subgroups.setdefault(next(digests), []).append(f)
+            for digest, subgroup in remove_small_groups(subgroups, minimum_size=2).items():
+                if len(stages) > 1:
+                    next_groups.append((size, stages[1:], subgroup))
+                else:
+                    content_groups.append((size, digest, subgroup))
+        groups = next_groups
+    return content_groups
+
+
+def get_hash_stages(size):
+    """
+    Get the digest functions to apply (in order) to files of given size.
+    """
+    if size is not None and size <= HEAD_BLOCK_SIZE:
+        # Head block covers the whole file: a single read is enough.
+        return [full_digest]
+    else:
+        return [head_digest, tail_digest, full_digest]
+
+
+def compute_digests(tasks, algorithm='md5', cache=None, executor=None, max_in_flight=16):
+    """
+    Generator of digests for a list of (digest function, FileEntry) tasks,
+    in the same order as the tasks.
+
+    @param tasks list of (digest function, FileEntry) tuples
+    @param algorithm name of the hash algorithm
+    @param cache optional DigestCache to look up/store digests
+    @param executor optional concurrent.futures executor to hash in parallel
+    @param max_in_flight maximum number of files submitted to the executor at once
+    """
+    def task(stage, entry):
+        return functools.partial(stage, algorithm=algorithm), entry.path
+
+    if cache is None:
+        tasks = [task(stage, entry) for stage, entry in tasks]
+        for digest in bounded_map(tasks, executor=executor, max_in_flight=max_in_flight):
+            yield digest
+        return
+
+    # Look up cached digests first, only hash the rest.
+    def stage_name(stage):
+        return '{a}:{s}'.format(a=algorithm, s=stage.__name__)
+
+    digests = [cache.get(entry, stage_name(stage)) for stage, entry in tasks]
+    misses = [i for i, digest in enumerate(digests) if digest is None]
+    computed = bounded_map([task(*tasks[i]) for i in misses], executor=executor, max_in_flight=max_in_flight)
+    for i, digest in zip(misses, computed):
+        cache.put(tasks[i][1], stage_name(tasks[i][0]), digest)
+        digests[i] = digest
+    for digest in digests:
+        yield digest
+
+
+def compare_contents(paths, first_chunk_size=HEAD_BLOCK_SIZE, chunk_size=CHUNK_SIZE):
+    """
+    Group same sized files on identical content by reading them side by side,
+    without hashing. A file is dropped (and not read any further)
+    as soon as its content differs from all the others.
+
+    @param paths list of file paths
+    @param first_chunk_size number of bytes of the first chunk to compare
+    @param chunk_size number of bytes of the subsequent chunks to compare
+
+    @return list of lists of file paths with identical content (two items or more)
+    """
+    files = {}
+    try:
+        for i, path in enumerate(paths):
+            files[i] = open(path, 'rb')
+        identical = []
+        candidates = [list(files.keys())]
+        size = first_chunk_size
+        while candidates:
+            next_candidates = []
+            for group in candidates:
+                chunks = {}
+                for i in group:
+                    chunks.setdefault(files[i].read(size), []).append(i)
+                for chunk, subgroup in chunks.items():
+                    if len(subgroup) < 2:
+                        files.pop(subgroup[0]).close()
+                    elif chunk == b'':
+                        identical.append(subgroup)
+                    else:
+                        next_candidates.append(subgroup)
+            candidates = next_candidates
+            size = chunk_size
+    finally:
+        for f in files.values():
+            f.close()
+    return [[paths[i] for i in group] for group in identical]
+
+
+def bounded_map(tasks, executor=None, max_in_flight=16):
+    """
+    Generator of results of (function, argument) tasks, in order,
+    optionally executed with an executor,
+    while keeping the number of pending tasks bounded.
+    """
+    if executor is None:
+        for function, argument in tasks:
+            yield function(argument)
+        return
+
+    pending = collections.deque()
+    for function, argument in tasks:
+        pending.append(executor.submit(function, argument))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def new_hash(algorithm='md5'):
+    """
+    Create a new hash object for given algorithm name
+    (hashlib algorithm or xxhash algorithm if available).
+    """
+    if algorithm.startswith('xxh'):
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def head_digest(filename, size=HEAD_BLOCK_SIZE, algorithm='md5'):
+    """
+    Calculate hash of the first bytes of the file.
+
+    @param filename file path of file to process
+    @param size the maximum number of bytes to read
+    @param algorithm name of the hash algorithm
+    """
+    h = new_hash(algorithm)
+    with open(filename, 'rb') as f:
+        h.update(f.read(size))
+    return h.hexdigest()
+
+
+def tail_digest(filename, size=TAIL_BLOCK_SIZE, algorithm='md5'):
+    """
+    Calculate hash of the last bytes of the file.
 
     @param filename file path of file to process
     @param size the maximum number of bytes to read
+    @param algorithm name of the hash algorithm
+    """
+    h = new_hash(algorithm)
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - size))
+        h.update(f.read(size))
+    return h.hexdigest()
+
+
+def full_digest(filename, algorithm='md5'):
+    """
+    Calculate hash of the full file contents (read in chunks).
+
+    @param filename file path of file to process
+    @param algorithm name of the hash algorithm
     """
+    h = new_hash(algorithm)
     with open(filename, 'rb') as f:
-        return hashlib.md5(f.read(size)).hexdigest()
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def benchmark_algorithms(algorithms=None, total_size=256 * 1024 * 1024):
+    """
+    Measure in-memory hashing throughput of hash algorithms.
+
+    @param algorithms list of algorithm names (all available algorithms by default)
+    @param total_size number of bytes to hash per algorithm
+
+    @return list of (algorithm, throughput in MB/s) tuples
+    """
+    chunk = os.urandom(CHUNK_SIZE)
+    results = []
+    for algorithm in algorithms or ALGORITHMS:
+        h = new_hash(algorithm)
+        start = time.perf_counter()
+        for i in range(max(1, total_size // CHUNK_SIZE)):
+            h.update(chunk)
+        h.hexdigest()
+        elapsed = time.perf_counter() - start
+        results.append((algorithm, max(1, total_size // CHUNK_SIZE) * CHUNK_SIZE / 1e6 / elapsed))
+    return results
+
+
+class DigestCache(object):
+    """
+    Persistent (SQLite based) cache of file digests.
+
+    Entries are keyed on device and inode and are only valid
+    for the file size and modification time they were stored with.
+    Stale entries are evicted when they are encountered.
+    Entries that were not used in a while (e.g. of deleted files)
+    are evicted on close.
+    """
+
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        """
+        @param path path of the SQLite file
+        @param max_age maximum time (in seconds) to keep entries that are not used
+            (0: only keep the entries used in this run)
+        """
+        self.max_age = max_age
+        self.run_time = int(time.time())
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            ' dev INTEGER, ino INTEGER, stage TEXT,'
+            ' size INTEGER, mtime_ns INTEGER, digest TEXT, last_seen INTEGER,'
+            ' PRIMARY KEY (dev, ino, stage))'
+        )
+        self._pending = 0
+
+    def get(self, entry, stage):
+        """
+        Look up the digest for a file.
+
+        @param entry FileEntry of the file
+        @param stage name of the digest stage
+
+        @return digest or None if not cached (or stale)
+        """
+        key = (_sqlite_int(entry.dev), _sqlite_int(entry.ino))
+        row = self.connection.execute(
+            'SELECT size, mtime_ns, digest FROM digests WHERE dev = ? AND ino = ? AND stage = ?',
+            key + (stage,)
+        ).fetchone()
+        if row is None:
+            return None
+        if (row[0], row[1]) != (entry.size, entry.mtime_ns):
+            # File changed since the digest was stored: evict all its entries.
+            self.connection.execute('DELETE FROM digests WHERE dev = ? AND ino = ?', key)
+            return None
+        self.connection.execute(
+            'UPDATE digests SET last_seen = ? WHERE dev = ? AND ino = ? AND stage = ?',
+            (int(time.time()),) + key + (stage,)
+        )
+        return row[2]
+
+    def evict(self, entry):
+        """
+        Remove all digests of a file.
+        """
+        self.connection.execute(
+            'DELETE FROM digests WHERE dev = ? AND ino = ?', (_sqlite_int(entry.dev), _sqlite_int(entry.ino))
+        )
+
+    def put(self, entry, stage, digest):
+        """
+        Store the digest for a file.
+
+        @param entry FileEntry of the file
+        @param stage name of the digest stage
+        @param digest digest to store
+        """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (_sqlite_int(entry.dev), _sqlite_int(entry.ino), stage,
+             entry.size, entry.mtime_ns, digest, int(time.time()))
+        )
+        self._pending += 1
+        if self._pending >= self.COMMIT_INTERVAL:
+            self.connection.commit()
+            self._pending = 0
+
+    def close(self):
+        # Evict entries (e.g. of deleted files) that were not used recently (or in this run).
+        self.connection.execute('DELETE FROM digests WHERE last_seen < ?', (self.run_time - self.max_age,))
+        self.connection.commit()
+        self.connection.close()
+
+
+class LiveDuplicateIndex(object):
+    """
+    Incrementally maintained index of files (grouped on size) to check
+    new files against. Digests are calculated lazily and cached,
+    so checking a file only reads the new file and (once)
+    the files of the same size.
+    """
+
+    def __init__(self, algorithm='md5', cache=None):
+        self.algorithm = algorithm
+        self.cache = cache if cache is not None else MemoryDigestCache()
+        self._by_size = {}
+        self._by_path = {}
+
+    def __len__(self):
+        return len(self._by_path)
+
+    def add(self, entry, check=True):
+        """
+        Add (or update) a file in the index.
+
+        @param entry FileEntry of the file
+        @param check whether to check the file for duplicates
+
+        @return (size, hash, list of files) duplicate group the file is part of,
+            or None if it has no duplicates (or check is disabled or the file is unchanged)
+        """
+        if self._by_path.get(entry.path) == entry:
+            return None
+        self.remove(entry.path)
+        group = self._by_size.setdefault(entry.size, {})
+        candidates = [e for e in group.values() if (e.dev, e.ino) != (entry.dev, entry.ino)]
+        group[entry.path] = entry
+        self._by_path[entry.path] = entry
+        if not check or not candidates:
+            return None
+        while True:
+            size_groups = {entry.size: collapse_hard_links(candidates) + [entry]}
+            try:
+                content_groups = group_on_content(size_groups, algorithm=self.algorithm, cache=self.cache)
+                break
+            except OSError:
+                # Drop indexed files that disappeared or became unreadable (without us noticing)
+                # and try again. If the new file itself is the problem, let the caller handle it.
+                unreadable = [e for e in candidates if not _is_readable(e.path)]
+                if not unreadable:
+                    raise
+                for e in unreadable:
+                    self.remove(e.path)
+                candidates = [e for e in candidates if e not in unreadable]
+                if not candidates:
+                    return None
+        for size, hash, files in content_groups:
+            if entry in files:
+                return size, hash, files
+        return None
+
+    def remove(self, path):
+        """
+        Remove a file from the index (if present).
+        """
+        entry = self._by_path.pop(path, None)
+        if entry is not None:
+            group = self._by_size[entry.size]
+            del group[path]
+            if not any((e.dev, e.ino) == (entry.dev, entry.ino) for e in group.values()):
+                # No hard links to the file left in the index.
+                self.cache.evict(entry)
+            if not group:
+                del self._by_size[entry.size]
+
+    def retain(self, paths):
+        """
+        Remove all files from the index that are not in the given set of paths.
+        """
+        for path in [p for p in self._by_path if p not in paths]:
+            self.remove(path)
+
+    def remove_tree(self, directory):
+        """
+        Remove all files in given directory (recursively) from the index.
+        """
+        prefix = os.path.join(directory, '')
+        for path in [p for p in self._by_path if p.startswith(prefix)]:
+            self.remove(path)
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    Minimal ctypes based wrapper of the Linux inotify API.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask):
+        """
+        Watch a path for given events.
+
+        @return watch descriptor
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """
+        Read available events (waiting at most timeout seconds when there are none).
+
+        @return list of (watch descriptor, mask, cookie, name) tuples
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+
+def watch_duplicates(seeds, report, algorithm='md5', cache=None, timeout=None, inotify=None):
+    """
+    Build a LiveDuplicateIndex of given seeds and keep it up to date with inotify,
+    reporting each file that is created (or moved in) as a duplicate of an existing file.
+
+    @param seeds list of files or directories (directories are watched)
+    @param report report writer
+    @param timeout stop after this number of seconds without events (run forever if None)
+    @param inotify optional Inotify instance to use
+    """
+    inotify = inotify or Inotify()
+    index = LiveDuplicateIndex(algorithm=algorithm, cache=cache)
+    watches = {}
+
+    def check_file(entry, check):
+        try:
+            content_group = index.add(entry, check=check)
+        except OSError:
+            # File disappeared or became unreadable in the meantime.
+            index.remove(entry.path)
+            return
+        if content_group is not None:
+            report.write_group(*content_group)
+
+    def watch_tree(directory, check):
+        # Add watches first, so that no files are missed while scanning.
+        for dirpath, dirnames, filenames in os.walk(directory):
+            try:
+                watches[inotify.add_watch(dirpath, WATCH_MASK)] = dirpath
+            except OSError:
+                pass
+        for entry in scan_files([directory]):
+            check_file(entry, check)
+
+    def unwatch_tree(directory):
+        index.remove_tree(directory)
+        prefix = os.path.join(directory, '')
+        for wd, dirpath in list(watches.items()):
+            if dirpath == directory or dirpath.startswith(prefix):
+                del watches[wd]
+                inotify.rm_watch(wd)
+
+    def build(check):
+        for seed in seeds:
+            if os.path.isdir(seed):
+                watch_tree(seed, check=check)
+            else:
+                for entry in scan_files([seed]):
+                    check_file(entry, check=check)
+
+    build(check=False)
+    try:
+        while True:
+            events = inotify.read_events(timeout=timeout)
+            if not events and timeout is not None:
+                break
+            for wd, mask, cookie, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost: drop the files that disappeared and rescan,
+                    # checking files that were created or changed in the meantime
+                    # (unchanged files are skipped by the index).
+                    sys.stderr.write('Inotify event queue overflow: rescanning\n')
+                    index.retain(set(e.path for e in scan_files(seeds)))
+                    build(check=True)
+                    continue
+                if wd not in watches:
+                    continue
+                if mask & IN_IGNORED:
+                    del watches[wd]
+                    continue
+                path = os.path.join(watches[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        watch_tree(path, check=True)
+                    elif mask & (IN_MOVED_FROM | IN_DELETE):
+                        unwatch_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    try:
+                        st = os.lstat(path)
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        check_file(FileEntry.from_stat(path, st), check=True)
+                elif mask & (IN_MOVED_FROM | IN_DELETE):
+                    index.remove(path)
+    finally:
+        inotify.close()
+
+
+INDEX_FORMAT = 'duplicate_searcher-index'
+INDEX_VERSION = 1
+
+
+def open_index(path, mode='rt'):
+    """
+    Open an index file (gzip compressed if the file name ends with .gz).
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding='utf-8', errors='surrogateescape')
+    return open(path, mode, encoding='utf-8', errors='surrogateescape')
+
+
+def write_index(
+        size_groups, out, node, algorithm='md5', cache=None, executor=None, max_in_flight=16, batch_size=64
+):
+    """
+    Write an index of files to be merged with indexes of other nodes later:
+    a JSON header line followed by a JSON line [size, partial digest, full digest, path] per file.
+
+    The partial (head block) digest is calculated for every file.
+    The full digest is only calculated for files that have a local duplicate candidate
+    (same size and partial digest) and is null otherwise.
+    For files that fit in the head block, partial and full digest are the same.
+
+    @param size_groups iterable of (size, list of FileEntry items) tuples
+    @param out file-like object to write to
+    @param node node name to record in the header
+    @param batch_size (minimum) number of files to hash per batch
+    """
+    header = {
+        'format': INDEX_FORMAT, 'version': INDEX_VERSION, 'node': node,
+        'algorithm': algorithm, 'head_block_size': HEAD_BLOCK_SIZE,
+    }
+    out.write(json.dumps(header) + '\n')
+
+    def digests(tasks):
+        return list(compute_digests(
+            tasks, algorithm=algorithm, cache=cache, executor=executor, max_in_flight=max_in_flight
+        ))
+
+    def write_batch(batch):
+        # Partial digests (full digests for small files)
+        files = [f for size, group in batch for f in group]
+        partials = digests([(full_digest if f.size <= HEAD_BLOCK_SIZE else head_digest, f) for f in files])
+        # Full digests of large files with a local duplicate candidate
+        candidates = group_on(
+            [(f, p) for f, p in zip(files, partials) if f.size > HEAD_BLOCK_SIZE], lambda c: (c[0].size, c[1])
+        )
+        candidates = [f for members in remove_small_groups(candidates).values() for f, p in members]
+        fulls = dict(zip((f.path for f in candidates), digests([(full_digest, f) for f in candidates])))
+        for f, partial in zip(files, partials):
+            full = partial if f.size <= HEAD_BLOCK_SIZE else fulls.get(f.path)
+            out.write(json.dumps([f.size, partial, full, f.path]) + '\n')
+
+    batch = []
+    batch_files = 0
+    for size, group in size_groups:
+        batch.append((size, group))
+        batch_files += len(group)
+        if batch_files >= batch_size:
+            write_batch(batch)
+            batch = []
+            batch_files = 0
+    write_batch(batch)
+
+
+def _read_index_header(f, path):
+    header = json.loads(f.readline())
+    if header.get('format') != INDEX_FORMAT or header.get('version') != INDEX_VERSION:
+        raise RuntimeError('Invalid index file "{0}"'.format(path))
+    return header
+
+
+def read_index_header(path):
+    """
+    Read the header of an index file written with write_index.
+
+    @return header dictionary
+    """
+    with open_index(path, 'rt') as f:
+        return _read_index_header(f, path)
+
+
+def read_index(path):
+    """
+    Read an index file written with write_index.
+
+    @return tuple (header dictionary, list of [size, partial digest, full digest, path] records)
+    """
+    with open_index(path, 'rt') as f:
+        header = _read_index_header(f, path)
+        return header, [json.loads(line) for line in f]
+
+
+def merge_indexes(paths, node=None):
+    """
+    Merge index files (e.g. from multiple nodes) and find duplicates across them.
+
+    Files with the same size and partial digest are compared on their full digest.
+    Missing full digests are calculated for files of the local node, if possible.
+    Groups that still have files without full digest are reported as unconfirmed,
+    with hash "partial:<partial digest>".
+
+    @param paths list of index file paths
+    @param node name of the local node
+
+    @return generator of (size, hash, list of FileEntry items) tuples, largest file size first,
+        where the path of each FileEntry is prefixed with the node name ("node:path")
+    """
+    settings = None
+    records = []
+    for path in paths:
+        header, index = read_index(path)
+        if settings is None:
+            settings = (header['algorithm'], header['head_block_size'])
+        elif settings != (header['algorithm'], header['head_block_size']):
+            raise RuntimeError('Index "{0}" was built with different algorithm/block size'.format(path))
+        records.extend((header['node'], size, partial, full, p) for size, partial, full, p in index)
+    if settings is None:
+        return
+    algorithm = settings[0]
+
+    def entry(record):
+        return FileEntry('{n}:{p}'.format(n=record[0], p=record[4]), record[1], 0, 0, 0)
+
+    size_groups = remove_small_groups(group_on(records, lambda r: r[1]), minimum_size=2)
+    for size, size_group in sort_size_groups(size_groups):
+        partial_groups = remove_small_groups(group_on(size_group, lambda r: r[2]), minimum_size=2)
+        for partial, group in partial_groups.items():
+            unconfirmed = []
+            fulls = []
+            for record in group:
+                full = record[3]
+                if full is None and record[0] == node and os.path.isfile(record[4]):
+                    if os.path.getsize(record[4]) == size:
+                        full = full_digest(record[4], algorithm=algorithm)
+                if full is None:
+                    unconfirmed.append(record)
+                else:
+                    fulls.append((full, record))
+            full_groups = group_on(fulls, lambda f: f[0])
+            if unconfirmed:
+                # Without full digests, report all candidates together.
+                yield size, 'partial:' + partial, [entry(r) for r in group]
+            else:
+                for full, members in remove_small_groups(full_groups, minimum_size=2).items():
+                    yield size, full, [entry(r) for f, r in members]
+
+
+# Linux ioctl to share (reflink) identical file ranges, see ioctl_fideduperange(2).
+FIDEDUPERANGE = 0xC0189436
+FILE_DEDUPE_RANGE = struct.Struct('<QQHHI')
+FILE_DEDUPE_RANGE_INFO = struct.Struct('<qQQiI')
+FILE_DEDUPE_RANGE_DIFFERS = 1
+DEDUPE_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def dedupe_file_range(source, target, length):
+    """
+    Let the kernel share the data extents of target with source
+    (after verifying that the contents are identical).
+
+    @param source path of source file
+    @param target path of target file
+    @param length number of bytes to deduplicate
+
+    @return True when deduplicated, False when the contents differ
+    @raise OSError when not supported (e.g. by the file system or platform)
+    """
+    try:
+        # Unix only.
+        import fcntl
+    except ImportError:
+        raise OSError(errno.ENOTSUP, 'FIDEDUPERANGE not supported on this platform')
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        target_fd = os.open(target, os.O_RDONLY)
+        try:
+            offset = 0
+            while offset < length:
+                request = min(length - offset, DEDUPE_CHUNK_SIZE)
+                buffer = bytearray(
+                    FILE_DEDUPE_RANGE.pack(offset, request, 1, 0, 0)
+                    + FILE_DEDUPE_RANGE_INFO.pack(target_fd, offset, 0, 0, 0)
+                )
+                fcntl.ioctl(source_fd, FIDEDUPERANGE, buffer, True)
+                _, _, deduped, status, _ = FILE_DEDUPE_RANGE_INFO.unpack_from(buffer, FILE_DEDUPE_RANGE.size)
+                if status == FILE_DEDUPE_RANGE_DIFFERS:
+                    return False
+                if status < 0:
+                    raise OSError(-status, os.strerror(-status), target)
+                if deduped == 0:
+                    raise OSError(errno.EIO, 'No progress deduplicating', target)
+                offset += deduped
+            return True
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+
+
+def replace_with_hard_link(source, target):
+    """
+    Atomically replace target with a hard link to source.
+    """
+    temp = os.path.join(
+        os.path.dirname(target), '.{name}.dedupe-{pid}'.format(name=os.path.basename(target), pid=os.getpid())
+    )
+    os.link(source, temp)
+    try:
+        os.replace(temp, target)
+    except OSError:
+        os.unlink(temp)
+        raise
+
+
+class Deduplicator(object):
+    """
+    Reclaim the space of duplicate files, without rewriting file data:
+    the data of each duplicate is shared with the first file of its group,
+    with the FIDEDUPERANGE ioctl where supported by the file system,
+    otherwise by replacing the duplicate with a hard link.
+    """
+
+    def __init__(self, dry_run=False, hard_links=True, log=sys.stderr):
+        self.dry_run = dry_run
+        self.hard_links = hard_links
+        self.log = log
+        self.reclaimed = 0
+        self.file_count = 0
+
+    def iter_deduplicated(self, content_groups):
+        """
+        Generator that deduplicates each (size, hash, list of files) group
+        before passing it on.
+        """
+        for size, hash, group in content_groups:
+            self.dedupe_group(size, group)
+            yield size, hash, group
+
+    def dedupe_group(self, size, entries):
+        """
+        Deduplicate the files of a confirmed duplicate group.
+
+        @param size file size
+        @param entries list of FileEntry items with identical content
+        """
+        if size == 0:
+            return
+        source = entries[0]
+        for target in entries[1:]:
+            if self.dry_run:
+                self.log.write('Would deduplicate {t} with {s}\n'.format(t=target.path, s=source.path))
+                method = 'dry run'
+            else:
+                try:
+                    method = self.dedupe_file(source, target)
+                except (OSError, ValueError) as e:
+                    self.log.write('Failed to deduplicate {t}: {e}\n'.format(t=target.path, e=e))
+                    continue
+                if method is None:
+                    self.log.write('Skipping {t}: changed since scan\n'.format(t=target.path))
+                    continue
+                self.log.write('Deduplicated {t} with {s} ({m})\n'.format(t=target.path, s=source.path, m=method))
+            self.reclaimed += size
+            self.file_count += 1
+
+    def dedupe_file(self, source, target):
+        """
+        Deduplicate a single file.
+
+        @param source FileEntry of file to keep
+        @param target FileEntry of file to share data with source
+
+        @return method used ('reflink' or 'hard link'),
+            or None if a file changed since it was scanned
+        @raise ValueError if the files can not be replaced by a hard link safely
+            (different content or mode, owner or group)
+        """
+        stats = [os.stat(entry.path) for entry in [source, target]]
+        for entry, st in zip([source, target], stats):
+            if FileEntry.from_stat(entry.path, st) != entry:
+                return None
+        try:
+            if dedupe_file_range(source.path, target.path, source.size):
+                return 'reflink'
+            else:
+                return None
+        except OSError:
+            if not self.hard_links or source.dev != target.dev:
+                raise
+        # Unlike FIDEDUPERANGE, replacing with a hard link does not verify the content
+        # and drops the metadata of the target: don't rely on an equal (possibly colliding) digest.
+        source_st, target_st = stats
+        if (source_st.st_mode, source_st.st_uid, source_st.st_gid) != \
+                (target_st.st_mode, target_st.st_uid, target_st.st_gid):
+            raise ValueError('mode, owner or group differs from {s}'.format(s=source.path))
+        if not compare_contents([source.path, target.path]):
+            raise ValueError('content differs from {s}'.format(s=source.path))
+        replace_with_hard_link(source.path, target.path)
+        return 'hard link'
+
+    def write_summary(self):
+        self.log.write('{v} {n} files, {b} B\n'.format(
+            v='Would deduplicate' if self.dry_run else 'Deduplicated', n=self.file_count, b=self.reclaimed
+        ))
+
+
+class TextReportWriter(object):
+    """
+    Human readable duplicate report.
+    """
+
+    def __init__(self, algorithm='md5', out=sys.stdout):
+        self.algorithm = algorithm
+        self.out = out
+        self.group_count = 0
+
+    def write_group(self, size, hash, entries):
+        if self.group_count == 0:
+            self.out.write("Found these possible duplicates (content hash algorithm: {a}):\n".format(a=self.algorithm))
+        if hash is None:
+            hash = '(byte by byte comparison)'
+        self.out.write('--- size: {size} B, content hash: {hash} ---\n'.format(size=size, hash=hash))
+        for entry in entries:
+            self.out.write(entry.path + '\n')
+        self.out.flush()
+        self.group_count += 1
+
+    def write_directory_group(self, size, hash, paths):
+        if self.group_count == 0:
+            self.out.write("Found these possible duplicates (content hash algorithm: {a}):\n".format(a=self.algorithm))
+        self.out.write('--- directories, total size: {size} B, tree hash: {hash} ---\n'.format(size=size, hash=hash))
+        for path in paths:
+            self.out.write(os.path.join(path, '') + '\n')
+        self.out.flush()
+        self.group_count += 1
+
+    def close(self):
+        if self.group_count == 0:
+            self.out.write('No duplicates found\n')
+        self.out.flush()
+
+
+class JsonLinesReportWriter(object):
+    """
+    Duplicate report with one JSON object per duplicate group (per line).
+    """
+
+    def __init__(self, algorithm='md5', out=sys.stdout):
+        self.algorithm = algorithm
+        self.out = out
+
+    def write_group(self, size, hash, entries):
+        record = {
+            'type': 'files',
+            'size': size,
+            'algorithm': self.algorithm if hash is not None else None,
+            'hash': hash,
+            'paths': [entry.path for entry in entries],
+        }
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+    def write_directory_group(self, size, hash, paths):
+        record = {
+            'type': 'directories',
+            'size': size,
+            'algorithm': self.algorithm,
+            'hash': hash,
+            'paths': paths,
+        }
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+    def close(self):
+        self.out.flush()
+
+
+class CsvReportWriter(object):
+    """
+    Duplicate report in CSV format, with one row per file.
+    """
+
+    def __init__(self, algorithm='md5', out=sys.stdout):
+        self.algorithm = algorithm
+        self.out = out
+        self.writer = csv.writer(out)
+        self.writer.writerow(['group', 'type', 'size', 'algorithm', 'hash', 'path'])
+        self.group_count = 0
+
+    def write_group(self, size, hash, entries):
+        algorithm = self.algorithm if hash is not None else ''
+        for entry in entries:
+            self.writer.writerow([self.group_count, 'file', size, algorithm, hash or '', entry.path])
+        self.out.flush()
+        self.group_count += 1
+
+    def write_directory_group(self, size, hash, paths):
+        for path in paths:
+            self.writer.writerow([self.group_count, 'directory', size, self.algorithm, hash, path])
+        self.out.flush()
+        self.group_count += 1
+
+    def close(self):
+        self.out.flush()
+
+
+REPORT_WRITERS = {
+    'text': TextReportWriter,
+    'jsonl': JsonLinesReportWriter,
+    'csv': CsvReportWriter,
+}
+
+
+class MemoryDigestCache(object):
+    """
+    In-memory digest cache (same interface as DigestCache).
+    """
+
+    def __init__(self):
+        self._digests = {}
+
+    def get(self, entry, stage):
+        size, mtime_ns, digest = self._digests.get((entry.dev, entry.ino), {}).get(stage, (None, None, None))
+        if (size, mtime_ns) != (entry.size, entry.mtime_ns):
+            return None
+        return digest
+
+    def put(self, entry, stage, digest):
+        self._digests.setdefault((entry.dev, entry.ino), {})[stage] = (entry.size, entry.mtime_ns, digest)
+
+    def evict(self, entry):
+        self._digests.pop((entry.dev, entry.ino), None)
+
+
+def _is_readable(path):
+    try:
+        with open(path, 'rb'):
+            return True
+    except OSError:
+        return False
+
+
+def _sqlite_int(value):
+    """Map unsigned 64 bit integer (e.g. inode number) to SQLite's signed 64 bit range."""
+    return value - (1 << 64) if value >= (1 << 63) else value
 
 
 if __name__ == '__main__':
@@ -5,24 +5,66 @@ Collect text file size stats, like number of lines, average line length,
 maximum line length, number of whitespace lines, ...
 """
 
-# TODO: detect and ignore binary files
-
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import heapq
+import io
+import itertools
+import json
+import lzma
 import os
+import sqlite3
 import sys
+import time
 import optparse
-from operator import attrgetter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BLOCK_SIZE = 1024 * 1024
+SNIFF_SIZE = 8 * 1024
+
+# Magic numbers of common binary file formats.
+# (Plain text prefixes like "MZ" for DOS/Windows executables are left out:
+# these formats are caught by the NUL byte check. bzip2 is checked with detect_compression.)
+BINARY_MAGIC_NUMBERS = [
+    (b'\x89PNG\r\n\x1a\n', 'PNG image'),
+    (b'GIF87a', 'GIF image'),
+    (b'GIF89a', 'GIF image'),
+    (b'\xff\xd8\xff', 'JPEG image'),
+    (b'%PDF-', 'PDF document'),
+    (b'PK\x03\x04', 'ZIP archive'),
+    (b'\x1f\x8b', 'gzip data'),
+    (b'\xfd7zXZ\x00', 'xz data'),
+    (b'\x28\xb5\x2f\xfd', 'zstd data'),
+    (b'7z\xbc\xaf\x27\x1c', '7-zip archive'),
+    (b'\x7fELF', 'ELF executable'),
+    (b'\xca\xfe\xba\xbe', 'Java class/Mach-O'),
+    (b'\xcf\xfa\xed\xfe', 'Mach-O executable'),
+    (b'SQLite format 3\x00', 'SQLite database'),
+]
+
+# Compression formats that can be decompressed on the fly.
+COMPRESSION_FORMATS = ['gzip', 'bzip2', 'xz', 'zstd']
+
+# Control characters that are common in text files (tab, newlines, form feed, backspace, escape).
+TEXT_CONTROL_CHARACTERS = b'\t\n\r\f\b\x1b'
+CONTROL_CHARACTERS = bytes(b for b in list(range(32)) + [127] if b not in TEXT_CONTROL_CHARACTERS)
 
 
 def get_lines(filename):
     '''
-    Get the lines of a text file (newlines will be stripped).
-
-    @return list of the file's lines
+    Generator for the lines of a text file (newlines are kept),
+    read in a streaming fashion.
     '''
-    f = open(filename, 'r')
-    lines = f.readlines()
-    f.close()
-    return lines
+    with open(filename, 'r') as f:
+        for line in f:
+            yield line
 
 
 def median(l):
@@ -30,9 +72,215 @@ def median(l):
     l = sorted(l)
     n = len(l)
     if n % 2 == 1:
-        return l[(n - 1) / 2]
+        return l[(n - 1) // 2]
     else:
-        return 0.5 * (l[n / 2 - 1] + l[n / 2])
+        return 0.5 * (l[n // 2 - 1] + l[n // 2])
+
+
+def histogram_quantile(histogram, q):
+    '''
+    Calculate an (interpolated) quantile from a histogram of values,
+    matching the median of the expanded list of values for q = 0.5.
+
+    @param histogram dictionary mapping value to count
+    @param q quantile (between 0 and 1)
+    '''
+    n = sum(histogram.values())
+    if n == 0:
+        return None
+    position = q * (n - 1)
+    lower_rank = int(position)
+    upper_rank = min(lower_rank + 1, n - 1)
+    fraction = position - lower_rank
+    lower = upper = None
+    seen = 0
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if lower is None and seen > lower_rank:
+            lower = value
+        if seen > upper_rank:
+            upper = value
+            break
+    if fraction == 0:
+        return lower
+    return lower + fraction * (upper - lower)
+
+
+class LineStats(object):
+    '''
+    Streaming line stats accumulator: feed it text in blocks of any size.
+    Only a histogram of line lengths is kept,
+    so memory usage does not depend on the amount of text.
+
+    Line lengths include the newline (like lines from readlines()).
+    '''
+
+    def __init__(self):
+        self.length_histogram = collections.Counter()
+        self.non_empty_line_qty = 0
+        # The unfinished last line is only tracked by its length and whether it is blank,
+        # so that (very) long lines do not have to be kept in memory.
+        self._partial_length = 0
+        self._partial_non_empty = False
+
+    def feed(self, text):
+        '''Process a block of text.'''
+        end = text.rfind('\n')
+        if end < 0:
+            self._feed_partial(text)
+            return
+        lines = text[:end].split('\n')
+        # The first line continues the unfinished line of the previous block.
+        self._feed_partial(lines[0])
+        self.length_histogram[self._partial_length + 1] += 1
+        if self._partial_non_empty:
+            self.non_empty_line_qty += 1
+        lines = lines[1:]
+        if lines:
+            for length, count in collections.Counter(map(len, lines)).items():
+                self.length_histogram[length + 1] += count
+            self.non_empty_line_qty += len(lines) - list(map(str.strip, lines)).count('')
+        self._partial_length = 0
+        self._partial_non_empty = False
+        self._feed_partial(text[end + 1:])
+
+    def _feed_partial(self, text):
+        self._partial_length += len(text)
+        if not self._partial_non_empty and text and not text.isspace():
+            self._partial_non_empty = True
+
+    def close(self):
+        '''Process the last line (if not terminated by a newline).'''
+        if self._partial_length:
+            self.length_histogram[self._partial_length] += 1
+            if self._partial_non_empty:
+                self.non_empty_line_qty += 1
+            self._partial_length = 0
+            self._partial_non_empty = False
+
+    @property
+    def line_qty(self):
+        return sum(self.length_histogram.values())
+
+    @property
+    def max_length(self):
+        return max(self.length_histogram) if self.length_histogram else None
+
+    @property
+    def average_length(self):
+        n = self.line_qty
+        if n == 0:
+            return None
+        return float(sum(length * count for length, count in self.length_histogram.items())) / n
+
+    @property
+    def median_length(self):
+        return histogram_quantile(self.length_histogram, 0.5)
+
+
+class BinaryFileError(ValueError):
+    '''Raised when trying to collect line stats of a binary file.'''
+
+    def __init__(self, filename, reason):
+        ValueError.__init__(self, 'Binary file "%s" (%s)' % (filename, reason))
+        self.filename = filename
+        self.reason = reason
+
+
+def sniff_binary(head, control_threshold=0.3):
+    '''
+    Detect binary content based on the leading block of a file:
+    known magic numbers, NUL bytes or a high fraction of control characters.
+
+    @param head leading bytes of the file
+    @param control_threshold maximum fraction of control characters for text
+
+    @return reason why content is considered binary, or None for text
+    '''
+    for magic, description in BINARY_MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return description
+    if detect_compression(head) == 'bzip2':
+        return 'bzip2 data'
+    if b'\x00' in head:
+        return 'NUL bytes'
+    if head:
+        control_qty = len(head) - len(head.translate(None, CONTROL_CHARACTERS))
+        if control_qty > control_threshold * len(head):
+            return 'control characters'
+    return None
+
+
+def detect_compression(head):
+    '''
+    Detect compression format from the magic number in the leading bytes of a file.
+
+    @return compression format name (see COMPRESSION_FORMATS) or None
+    '''
+    if head.startswith(b'\x1f\x8b\x08'):
+        return 'gzip'
+    if head.startswith(b'BZh') and head[3:4].isdigit() and head[4:10] in (b'1AY&SY', b'\x17rE8P\x90'):
+        return 'bzip2'
+    if head.startswith(b'\xfd7zXZ\x00'):
+        return 'xz'
+    if head.startswith(b'\x28\xb5\x2f\xfd'):
+        return 'zstd'
+    return None
+
+
+def open_decompressed(raw, compression):
+    '''
+    Wrap a binary file object with a streaming decompressor.
+
+    @return buffered binary file-like object (supporting peek)
+    '''
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    elif compression == 'bzip2':
+        return bz2.BZ2File(raw)
+    elif compression == 'xz':
+        return lzma.LZMAFile(raw)
+    elif compression == 'zstd':
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=False))
+    raise ValueError(compression)
+
+
+DECOMPRESSION_ERRORS = (OSError, EOFError, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def collect_line_stats(filename, block_size=BLOCK_SIZE, detect_binary=True, decompress=True):
+    '''
+    Collect line stats of a text file, reading it in large blocks.
+
+    @param detect_binary whether to check the leading block of the file
+        for binary content first (and raise BinaryFileError)
+    @param decompress whether to detect compressed files (gzip, bzip2, xz, zstd)
+        and collect the stats of the decompressed content (streaming)
+
+    @return LineStats
+    '''
+    stats = LineStats()
+    with open(filename, 'rb') as raw:
+        stream = raw
+        compression = detect_compression(raw.peek(SNIFF_SIZE)) if decompress else None
+        if compression == 'zstd' and zstandard is None:
+            raise BinaryFileError(filename, 'zstd data, zstandard package not installed')
+        try:
+            if compression is not None:
+                stream = open_decompressed(raw, compression)
+            if detect_binary:
+                reason = sniff_binary(stream.peek(SNIFF_SIZE)[:SNIFF_SIZE])
+                if reason is not None:
+                    raise BinaryFileError(filename, reason)
+            with io.TextIOWrapper(stream) as f:
+                for block in iter(lambda: f.read(block_size), ''):
+                    stats.feed(block)
+        except DECOMPRESSION_ERRORS:
+            if compression is None:
+                raise
+            raise BinaryFileError(filename, 'invalid %s data' % compression)
+    stats.close()
+    return stats
 
 
 class FileSizeStat(object):
@@ -47,6 +295,8 @@ class FileSizeStat(object):
     average_length = None
     median_length = None
     empty_line_fraction = None
+    binary = None
+    length_histogram = None
 
     @staticmethod
     def get_sort_fields():
@@ -58,23 +308,67 @@ class FileSizeStat(object):
         return ['line_qty', 'non_empty_line_qty', 'max_length', 'average_length', 'median_length',
                 'empty_line_fraction']
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, detect_binary=True, keep_histogram=False, decompress=True):
         '''
         Collect file size stats.
+
+        @param detect_binary whether to detect binary files (and skip collecting stats)
+        @param decompress whether to collect stats of the decompressed content of compressed files
+        @param keep_histogram whether to keep the line length histogram (e.g. for aggregation)
         '''
         self.filename = filename
 
-        lines = get_lines(self.filename)
-        self.line_qty = len(lines)
+        try:
+            stats = collect_line_stats(self.filename, detect_binary=detect_binary, decompress=decompress)
+        except BinaryFileError as e:
+            self.binary = e.reason
+            return
+        except UnicodeDecodeError:
+            if not detect_binary:
+                raise
+            self.binary = 'invalid text encoding'
+            return
+        self.line_qty = stats.line_qty
+        if keep_histogram:
+            self.length_histogram = stats.length_histogram
         if self.line_qty > 0:
-            self.non_empty_line_qty = len([l for l in lines if l.strip() != ''])
-            line_lengths = [len(l) for l in lines]
-            self.max_length = max(line_lengths)
-            self.average_length = float(sum(line_lengths)) / self.line_qty
-            self.median_length = median(line_lengths)
+            self.non_empty_line_qty = stats.non_empty_line_qty
+            self.max_length = stats.max_length
+            self.average_length = stats.average_length
+            self.median_length = stats.median_length
             self.empty_line_fraction = float(self.line_qty - self.non_empty_line_qty) / self.line_qty
 
+    FIELDS = ['line_qty', 'non_empty_line_qty', 'max_length', 'average_length', 'median_length',
+              'empty_line_fraction', 'binary']
+
+    def to_fields(self):
+        '''
+        Get the collected stats as a (JSON serializable) dictionary.
+        '''
+        fields = dict((name, getattr(self, name)) for name in self.FIELDS)
+        if self.length_histogram is not None:
+            fields['length_histogram'] = dict((str(k), v) for k, v in self.length_histogram.items())
+        return fields
+
+    @classmethod
+    def from_fields(cls, filename, fields):
+        '''
+        Build FileSizeStat from previously collected stats (see to_fields).
+        '''
+        fss = cls.__new__(cls)
+        fss.filename = filename
+        for name in cls.FIELDS:
+            setattr(fss, name, fields.get(name))
+        if fields.get('length_histogram') is not None:
+            fss.length_histogram = collections.Counter(
+                dict((int(k), v) for k, v in fields['length_histogram'].items())
+            )
+        return fss
+
     def render(self):
+        if self.binary is not None:
+            return 'binary: %s; %s' % (self.binary, self.filename)
+
         cols = []
 
         cols.append('lineqty: {qty:5d}'.format(qty=self.line_qty))
@@ -104,6 +398,77 @@ class FileSizeStat(object):
         return '; '.join(cols)
 
 
+class AggregateStats(object):
+    '''
+    Tree-wide line stats, aggregated from FileSizeStat objects
+    (with line length histogram). Aggregates can be merged
+    (e.g. from other processes or saved runs) without loss:
+    quantiles are computed from the exact line length histogram.
+    '''
+
+    QUANTILES = [0.5, 0.95, 0.99]
+
+    def __init__(self):
+        self.file_qty = 0
+        self.binary_qty = 0
+        self.non_empty_line_qty = 0
+        self.length_histogram = collections.Counter()
+
+    def add(self, fss):
+        '''Fold in the stats of a file.'''
+        self.file_qty += 1
+        if fss.binary is not None:
+            self.binary_qty += 1
+        else:
+            self.non_empty_line_qty += fss.non_empty_line_qty or 0
+            self.length_histogram.update(fss.length_histogram)
+
+    def merge(self, other):
+        '''Fold in another aggregate.'''
+        self.file_qty += other.file_qty
+        self.binary_qty += other.binary_qty
+        self.non_empty_line_qty += other.non_empty_line_qty
+        self.length_histogram.update(other.length_histogram)
+
+    @property
+    def line_qty(self):
+        return sum(self.length_histogram.values())
+
+    def quantile(self, q):
+        return histogram_quantile(self.length_histogram, q)
+
+    def to_json(self):
+        return json.dumps({
+            'file_qty': self.file_qty,
+            'binary_qty': self.binary_qty,
+            'non_empty_line_qty': self.non_empty_line_qty,
+            'length_histogram': dict((str(k), v) for k, v in sorted(self.length_histogram.items())),
+        })
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        aggregate = cls()
+        aggregate.file_qty = data['file_qty']
+        aggregate.binary_qty = data['binary_qty']
+        aggregate.non_empty_line_qty = data['non_empty_line_qty']
+        aggregate.length_histogram.update(dict((int(k), v) for k, v in data['length_histogram'].items()))
+        return aggregate
+
+    def render(self):
+        lines = [
+            'files: {n:d} ({b:d} binary)'.format(n=self.file_qty, b=self.binary_qty),
+            'lines: {n:d} ({e:d} non-empty)'.format(n=self.line_qty, e=self.non_empty_line_qty),
+        ]
+        if self.line_qty > 0:
+            total = sum(length * count for length, count in self.length_histogram.items())
+            lines.append('avglen: {avg:.1f}'.format(avg=float(total) / self.line_qty))
+            for q in self.QUANTILES:
+                lines.append('p{p:g}len: {v:.1f}'.format(p=100 * q, v=self.quantile(q)))
+            lines.append('maxlen: {m:d}'.format(m=max(self.length_histogram)))
+        return '\n'.join(lines)
+
+
 def generate_file_paths(paths, recurse):
     '''
     Generator for file paths from a list of file and directory paths
@@ -123,6 +488,205 @@ def generate_file_paths(paths, recurse):
             sys.stderr.write('Warning: ignoring invalid path "%s".\n' % path)
 
 
+def _collect_file_size_stats(paths, options):
+    '''Worker helper: build FileSizeStat for each of the given paths.'''
+    return [FileSizeStat(path, **options) for path in paths]
+
+
+def generate_file_size_stats(paths, jobs=1, ordered=True, chunk_size=16, cache=None, **options):
+    '''
+    Generator for FileSizeStat objects of given file paths,
+    optionally computed in a pool of worker processes.
+
+    @param paths iterable of file paths
+    @param jobs number of worker processes (no pool if 1)
+    @param ordered whether to keep the order of the given paths
+        (through a bounded reorder buffer) or to produce results as they finish
+    @param chunk_size number of files per worker task
+    @param cache optional StatsCache to look up/store stats
+    @param options additional FileSizeStat options
+    '''
+    if jobs <= 1:
+        chunk_size = 1
+    paths = iter(paths)
+    chunks = iter(lambda: list(itertools.islice(paths, chunk_size)), [])
+
+    def lookup(chunk):
+        # List of (cached FileSizeStat or None, os.stat result) tuples
+        if cache is None:
+            return [(None, None)] * len(chunk)
+        return [cache.get(path, options) for path in chunk]
+
+    def misses(chunk, looked_up):
+        return [path for path, (fss, st) in zip(chunk, looked_up) if fss is None]
+
+    def complete(chunk, looked_up, computed):
+        computed = iter(computed)
+        result = []
+        for path, (fss, st) in zip(chunk, looked_up):
+            if fss is None:
+                fss = next(computed)
+                if cache is not None and st is not None:
+                    cache.put(path, st, options, fss)
+            result.append(fss)
+        return result
+
+    if jobs <= 1:
+        for chunk in chunks:
+            looked_up = lookup(chunk)
+            computed = _collect_file_size_stats(misses(chunk, looked_up), options)
+            for stat in complete(chunk, looked_up, computed):
+                yield stat
+        return
+
+    max_pending = 4 * jobs
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+
+        def submit(chunk):
+            looked_up = lookup(chunk)
+            to_compute = misses(chunk, looked_up)
+            if to_compute:
+                future = executor.submit(_collect_file_size_stats, to_compute, options)
+            else:
+                future = concurrent.futures.Future()
+                future.set_result([])
+            return chunk, looked_up, future
+
+        if ordered:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(submit(chunk))
+                if len(pending) >= max_pending:
+                    chunk, looked_up, future = pending.popleft()
+                    for stat in complete(chunk, looked_up, future.result()):
+                        yield stat
+            while pending:
+                chunk, looked_up, future = pending.popleft()
+                for stat in complete(chunk, looked_up, future.result()):
+                    yield stat
+        else:
+            pending = {}
+            for chunk in chunks:
+                chunk, looked_up, future = submit(chunk)
+                pending[future] = (chunk, looked_up)
+                if len(pending) >= max_pending:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        chunk, looked_up = pending.pop(future)
+                        for stat in complete(chunk, looked_up, future.result()):
+                            yield stat
+            for future in concurrent.futures.as_completed(pending):
+                chunk, looked_up = pending[future]
+                for stat in complete(chunk, looked_up, future.result()):
+                    yield stat
+
+
+class StatsCache(object):
+    '''
+    Persistent (SQLite based) cache of FileSizeStat fields.
+
+    Entries are keyed on file path (and stat options) and are only valid
+    for the file size, modification time and inode they were stored with.
+    Only the most recently used entries are kept (up to a maximum number).
+    '''
+
+    def __init__(self, path, max_entries=100000):
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS stats ('
+            ' path TEXT, options TEXT, size INTEGER, mtime_ns INTEGER, ino INTEGER,'
+            ' fields TEXT, last_used INTEGER,'
+            ' PRIMARY KEY (path, options))'
+        )
+        self.now = time.time_ns()
+
+    @staticmethod
+    def _options_key(options):
+        # Histograms are stored when available, so keep_histogram is not part of the key.
+        return json.dumps(dict((k, v) for k, v in options.items() if k != 'keep_histogram'), sort_keys=True)
+
+    def get(self, path, options):
+        '''
+        Look up cached stats of a file.
+
+        @param path file path
+        @param options FileSizeStat options
+
+        @return tuple (FileSizeStat or None if not cached, os.stat result or None if unavailable)
+        '''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, None
+        key = (path, self._options_key(options))
+        row = self.connection.execute(
+            'SELECT size, mtime_ns, ino, fields FROM stats WHERE path = ? AND options = ?', key
+        ).fetchone()
+        if row is None or tuple(row[:3]) != (st.st_size, st.st_mtime_ns, _sqlite_int(st.st_ino)):
+            return None, st
+        fields = json.loads(row[3])
+        if options.get('keep_histogram') and fields.get('length_histogram') is None and fields.get('binary') is None:
+            return None, st
+        self.connection.execute('UPDATE stats SET last_used = ? WHERE path = ? AND options = ?', (self.now,) + key)
+        return FileSizeStat.from_fields(path, fields), st
+
+    def put(self, path, st, options, fss):
+        '''
+        Store stats of a file.
+
+        @param path file path
+        @param st os.stat result of the file (from before collecting the stats)
+        @param options FileSizeStat options
+        @param fss FileSizeStat
+        '''
+        self.connection.execute(
+            'INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, self._options_key(options), st.st_size, st.st_mtime_ns, _sqlite_int(st.st_ino),
+             json.dumps(fss.to_fields()), self.now)
+        )
+
+    def close(self):
+        # Evict least recently used entries.
+        self.connection.execute(
+            'DELETE FROM stats WHERE rowid IN (SELECT rowid FROM stats ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+        self.connection.commit()
+        self.connection.close()
+
+
+def _sqlite_int(value):
+    '''Map unsigned 64 bit integer (e.g. inode number) to SQLite's signed 64 bit range.'''
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def get_sort_key(field):
+    '''
+    Get sort key function for given FileSizeStat field
+    (entries without value, e.g. empty or binary files, sort first).
+    '''
+    def sort_key(fss):
+        value = getattr(fss, field)
+        return (value is not None, value if value is not None else 0)
+
+    return sort_key
+
+
+def top_stats(stats, n, field):
+    '''
+    Get the N entries with the highest value of given field,
+    keeping only a bounded heap of N entries in memory while consuming the stats.
+
+    @param stats iterable of FileSizeStat objects
+    @param n number of entries to keep
+    @param field sort field
+
+    @return list of FileSizeStat objects, sorted on given field (ascending)
+    '''
+    return list(reversed(heapq.nlargest(n, stats, key=get_sort_key(field))))
+
+
 def main():
     possible_sort_fields = FileSizeStat.get_sort_fields()
 
@@ -137,22 +701,99 @@ def main():
         dest='sort_field', action='store', default=None,
         help='Sort field to sort stats on (possible fields: %s).' % (', '.join(possible_sort_fields))
     )
+    cli_parser.add_option(
+        '-t', '--top',
+        dest='top', action='store', type='int', default=None,
+        help='Only show the N entries with the highest value of the sort field'
+             ' (keeping only those in memory).'
+    )
+    cli_parser.add_option(
+        '-a', '--aggregate',
+        dest='aggregate', action='store_true', default=False,
+        help='Only show tree-wide aggregated stats (total lines, line length distribution).'
+    )
+    cli_parser.add_option(
+        '--save-aggregate',
+        dest='save_aggregate', action='store', default=None, metavar='FILE',
+        help='Save aggregated stats to a file (to merge with --load-aggregate later).'
+    )
+    cli_parser.add_option(
+        '--load-aggregate',
+        dest='load_aggregate', action='append', default=[], metavar='FILE',
+        help='Merge aggregated stats saved earlier (can be used multiple times).'
+    )
+    cli_parser.add_option(
+        '-b', '--binary',
+        dest='binary', action='store', type='choice', choices=['skip', 'tag', 'read'], default='skip',
+        help='How to handle binary files (detected from a small leading block):'
+             ' "skip" (default), "tag" (list them as binary) or "read" (process them as text anyway).'
+    )
+    cli_parser.add_option(
+        '--no-decompress',
+        dest='decompress', action='store_false', default=True,
+        help='Do not decompress gzip/bzip2/xz/zstd compressed files on the fly (handle them as binary files).'
+    )
+    cli_parser.add_option(
+        '--cache',
+        dest='cache', action='store', default=None, metavar='FILE',
+        help='SQLite file to cache stats in between runs (unchanged files are not read again).'
+    )
+    cli_parser.add_option(
+        '--cache-size',
+        dest='cache_size', action='store', type='int', default=100000, metavar='N',
+        help='Maximum number of entries to keep in the cache (least recently used are evicted).'
+    )
+    cli_parser.add_option(
+        '-j', '--jobs',
+        dest='jobs', action='store', type='int', default=1,
+        help='Number of worker processes to collect stats with.'
+    )
 
     (options, paths) = cli_parser.parse_args()
+    stat_options = dict(detect_binary=options.binary != 'read', decompress=options.decompress)
+    if options.top is not None and options.sort_field is None:
+        cli_parser.error('Option --top requires a sort field (--sort)')
+    cache = StatsCache(options.cache, max_entries=options.cache_size) if options.cache else None
 
-    if options.sort_field == None:
+    if options.aggregate or options.save_aggregate or options.load_aggregate:
+        # Aggregation: fold all stats (and saved aggregates) into one summary.
+        aggregate = AggregateStats()
+        for path in options.load_aggregate:
+            with open(path) as f:
+                aggregate.merge(AggregateStats.from_json(f.read()))
+        file_paths = generate_file_paths(paths, options.recursive)
+        stats = generate_file_size_stats(
+            file_paths, jobs=options.jobs, cache=cache, ordered=False, keep_histogram=True, **stat_options
+        )
+        for fss in stats:
+            aggregate.add(fss)
+        if options.save_aggregate:
+            with open(options.save_aggregate, 'w') as f:
+                f.write(aggregate.to_json())
+        print(aggregate.render())
+    elif options.sort_field == None:
         # No sorting: render stats immediately.
-        for path in generate_file_paths(paths, options.recursive):
-            print(FileSizeStat(path).render())
+        file_paths = generate_file_paths(paths, options.recursive)
+        for fss in generate_file_size_stats(file_paths, jobs=options.jobs, cache=cache, ordered=True, **stat_options):
+            if fss.binary is None or options.binary == 'tag':
+                print(fss.render())
     elif options.sort_field in possible_sort_fields:
         # Sorting: first collect stats and render after sorting
-        stats = [FileSizeStat(path) for path in generate_file_paths(paths, options.recursive)]
-        stats.sort(key=attrgetter(options.sort_field))
+        file_paths = generate_file_paths(paths, options.recursive)
+        stats = generate_file_size_stats(file_paths, jobs=options.jobs, cache=cache, ordered=False, **stat_options)
+        stats = (fss for fss in stats if fss.binary is None or options.binary == 'tag')
+        if options.top is not None:
+            stats = top_stats(stats, options.top, options.sort_field)
+        else:
+            stats = sorted(stats, key=get_sort_key(options.sort_field))
         for fss in stats:
             print(fss.render())
     else:
         cli_parser.error('Invalid sort field "%s"\n' % options.sort_field)
 
+    if cache is not None:
+        cache.close()
+
 
 if __name__ == '__main__':
     main()
@@ -10,38 +10,73 @@ and build a histogram from it
 """
 
 import argparse
+import array
+import codecs
+import collections
+import collections.abc
+import concurrent.futures
+import heapq
+import io
+import itertools
+import locale
 import operator
+import os
+import selectors
+import stat
+import struct
 import sys
+import time
+import zlib
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-class ObjectHistogram(dict):
+
+# Number of lines to tokenize in one go when observing words.
+BATCH_LINES = 16 * 1024
+
+# Size of the byte ranges large files are split in for parallel counting.
+RANGE_SIZE = 64 * 1024 * 1024
+
+# Size of the blocks to read (and decode) at once when counting a byte range.
+BLOCK_SIZE = 1024 * 1024
+
+SNAPSHOT_MAGIC = b'ObjHist\0'
+SNAPSHOT_VERSION = 1
+# Snapshot header: magic, version, number of entries.
+SNAPSHOT_HEADER = struct.Struct('<8sBQ')
+
+
+class ObjectHistogram(collections.Counter):
     """
     Basic histogram builder for observing general objects.
-    """
 
-    def __init__(self):
-        dict.__init__(self)
+    Counting is done in bulk through Counter.update (which counts
+    in C), instead of a Python level dictionary update per observation.
+    """
 
     def observe(self, x):
         """
         Add an observation to the histogram.
         """
-        self[x] = self.get(x, 0) + 1
+        self[x] += 1
 
     def observe_lines_from_file(self, source):
         """
         Observe the lines from a file-like source.
         """
-        for line in source:
-            self.observe(line)
+        self.update(source)
 
     def observe_words_from_file(self, source):
         """
         Observe the words from a file-like source.
         """
-        for line in source:
-            for word in line.split():
-                self.observe(word)
+        source = iter(source)
+        for lines in iter(lambda: list(itertools.islice(source, BATCH_LINES)), []):
+            # Tokenize a whole batch of lines with a single split call.
+            self.update(' '.join(lines).split())
 
     def observe_from_sources(self, sources, observe_lines=False):
         """
@@ -64,29 +99,592 @@ class ObjectHistogram(dict):
             if isinstance(source, str):
                 f.close()
 
+    def write(self, f):
+        """
+        Write a compact binary snapshot of the histogram (with string keys)
+        to a file object opened in binary mode.
+
+        Format: header (see SNAPSHOT_HEADER) followed by a zlib compressed payload:
+        the key lengths and counts (as little endian unsigned 64 bit integers)
+        and the concatenated (UTF-8 encoded) keys.
+        """
+        try:
+            keys = [k.encode('utf-8', 'surrogateescape') for k in self]
+        except AttributeError:
+            raise TypeError('Only histograms with string keys can be written.')
+        lengths = array.array('Q', map(len, keys))
+        counts = array.array('Q', self.values())
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            counts.byteswap()
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(keys)))
+        compressor = zlib.compressobj()
+        for data in [lengths.tobytes(), counts.tobytes(), b''.join(keys)]:
+            f.write(compressor.compress(data))
+        f.write(compressor.flush())
+
+    @classmethod
+    def read(cls, f):
+        """
+        Read a histogram snapshot (see write) from a file object opened in binary mode.
+        """
+        header = f.read(SNAPSHOT_HEADER.size)
+        if len(header) != SNAPSHOT_HEADER.size or not header.startswith(SNAPSHOT_MAGIC):
+            raise ValueError('Not a histogram snapshot.')
+        _, version, size = SNAPSHOT_HEADER.unpack(header)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported histogram snapshot version %d.' % version)
+        try:
+            data = zlib.decompress(f.read())
+        except zlib.error:
+            raise ValueError('Corrupt histogram snapshot.')
+        lengths = array.array('Q', data[:8 * size])
+        counts = array.array('Q', data[8 * size:16 * size])
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            counts.byteswap()
+        blob = data[16 * size:]
+        offsets = list(itertools.accumulate(lengths, initial=0))
+        if len(counts) != size or offsets[-1] != len(blob):
+            raise ValueError('Corrupt histogram snapshot.')
+        keys = (blob[a:b].decode('utf-8', 'surrogateescape') for a, b in zip(offsets, offsets[1:]))
+        histogram = cls()
+        dict.update(histogram, zip(keys, counts))
+        return histogram
+
     def ordered_items(self):
         """
         Return an ordered list of histogram items
         (from highest count to lowest count).
         """
-        items = list(self.items())
-        items.sort(lambda a, b: -cmp(a[1], b[1]))
-        return items
+        return self.most_common()
 
     def ascii_plot(self, keysort=False, limit=None, out=sys.stdout):
         """
         Make a plot in text (ASCII) format.
         """
+        if not self:
+            return
         if keysort:
-            items = sorted(list(self.items()), key=operator.itemgetter(0), reverse=False)
+            items = sorted(self.items(), key=operator.itemgetter(0))[:limit]
         else:
-            items = sorted(list(self.items()), key=operator.itemgetter(1), reverse=True)
-        max_count = max(self.values())
-        total_count = sum(self.values())
-        for obj, count in items[:limit]:
+            items = self.most_common(limit)
+        self._write_plot(items, max(self.values()), sum(self.values()), out)
+
+    def _write_plot(self, items, max_count, total_count, out):
+        for obj, count in items:
             bar = '#' * int(20.0 * count / max_count)
             label = str(obj).rstrip()
-            out.write('%20s %5d (%5.2f%%) %s\n' % (bar, count, 100.0 * count / total_count, label))
+            percentage = 100.0 * count / total_count
+            out.write('%20s %s (%5.2f%%) %s\n' % (bar, self.format_count(obj, count), percentage, label))
+
+    def format_count(self, obj, count):
+        """
+        Format the count of an object for the ASCII plot.
+        """
+        return '%5d' % count
+
+
+class HeavyHitterHistogram(ObjectHistogram):
+    """
+    Approximate histogram that only tracks the most frequent objects
+    with a fixed number of counters, regardless of the number of
+    distinct objects observed ("Space-Saving" algorithm,
+    Metwally et al. 2005).
+
+    The count of a tracked object overestimates its true count
+    by at most its error (see the errors attribute), which is
+    at most the total count divided by the number of counters.
+    Objects with a true count above that bound are guaranteed
+    to be tracked.
+    """
+
+    def __init__(self, capacity):
+        """
+        @param capacity number of counters (tracked objects)
+        """
+        self.capacity = capacity
+        self.errors = {}
+        # Min-heap of (count, sequence number, object) with possibly outdated (too low) counts.
+        self._heap = []
+        self._sequence = itertools.count()
+        ObjectHistogram.__init__(self)
+
+    def observe(self, x):
+        self._add(x, 1)
+
+    def update(self, iterable):
+        """
+        Observe all objects from an iterable, or (object, count) pairs from a mapping.
+        """
+        if iterable is None:
+            return
+        if isinstance(iterable, collections.abc.Mapping):
+            batches = [iterable.items()]
+        else:
+            # Pre-aggregate batches in C to reduce the work per observation.
+            iterable = iter(iterable)
+            batches = (
+                collections.Counter(batch).items()
+                for batch in iter(lambda: list(itertools.islice(iterable, BATCH_LINES)), [])
+            )
+        for batch in batches:
+            for x, n in batch:
+                self._add(x, n)
+
+    def _add(self, x, n):
+        if x in self:
+            self[x] += n
+            return
+        if len(self) < self.capacity:
+            error = 0
+        else:
+            # Replace the object with the lowest count and inherit its count as error.
+            error, evicted = self._pop_minimum()
+            del self[evicted]
+            del self.errors[evicted]
+        self[x] = error + n
+        self.errors[x] = error
+        heapq.heappush(self._heap, (error + n, next(self._sequence), x))
+
+    def _pop_minimum(self):
+        while True:
+            count, _, x = heapq.heappop(self._heap)
+            if self[x] == count:
+                return count, x
+            # Outdated entry: push it back with its current count.
+            heapq.heappush(self._heap, (self[x], next(self._sequence), x))
+
+    def format_count(self, obj, count):
+        return '%5d (>= %d)' % (count, count - self.errors[obj])
+
+
+class LiveHistogram(ObjectHistogram):
+    """
+    Histogram for live streams, with optional exponential decay
+    of old observations, that maintains its top entries incrementally,
+    so that these can be plotted at a cost that does not depend
+    on the number of entries.
+
+    Decay is implemented with a global scale factor: instead of decaying
+    all counts, new observations get a weight that grows exponentially
+    over time (and all weights are renormalized once in a while).
+    As weights only grow, an entry can only enter the top on an update of its own.
+    """
+
+    # Number of half-lives after which weights are renormalized.
+    RENORMALIZE_HALF_LIVES = 32
+    # Weight (in observations) below which entries are dropped on renormalization.
+    PRUNE_WEIGHT = 1e-3
+
+    def __init__(self, limit=20, half_life=None, clock=time.monotonic):
+        """
+        @param limit number of top entries to maintain
+        @param half_life half-life (in seconds) of observations (None: no decay)
+        @param clock function that returns the current time in seconds
+        """
+        self.limit = limit
+        self.half_life = half_life
+        self.clock = clock
+        self._epoch = clock()
+        self._total = 0
+        # Top entries (dict as insertion ordered set) and a lower bound of their minimum weight.
+        self._top = {}
+        self._top_minimum = 0
+        ObjectHistogram.__init__(self)
+
+    def _scale(self):
+        """
+        Current weight of one observation.
+        """
+        if self.half_life is None:
+            return 1
+        now = self.clock()
+        exponent = (now - self._epoch) / self.half_life
+        if exponent > self.RENORMALIZE_HALF_LIVES:
+            # Renormalize (this preserves the order of the entries) and prune
+            # entries with a negligible weight, so that memory does not keep growing.
+            factor = 2.0 ** -exponent
+            self._total *= factor
+            for x in list(self):
+                weight = self[x] * factor
+                if weight < self.PRUNE_WEIGHT and x not in self._top:
+                    del self[x]
+                    self._total -= weight
+                else:
+                    self[x] = weight
+            self._top_minimum *= factor
+            self._epoch = now
+            exponent = 0
+        return 2.0 ** exponent
+
+    def observe(self, x):
+        self._add(x, self._scale())
+
+    def update(self, iterable):
+        """
+        Observe all objects from an iterable.
+        """
+        if iterable is None:
+            return
+        iterable = iter(iterable)
+        for batch in iter(lambda: list(itertools.islice(iterable, BATCH_LINES)), []):
+            scale = self._scale()
+            for x, n in collections.Counter(batch).items():
+                self._add(x, n * scale)
+
+    def _add(self, x, weight):
+        self[x] += weight
+        self._total += weight
+        if x in self._top:
+            return
+        if len(self._top) < self.limit:
+            self._top[x] = None
+        elif self[x] > self._top_minimum:
+            minimum = min(self._top, key=self.__getitem__)
+            if self[x] > self[minimum]:
+                del self._top[minimum]
+                self._top[x] = None
+                minimum = min(self._top, key=self.__getitem__)
+            self._top_minimum = self[minimum]
+
+    def top_items(self):
+        """
+        Get the top entries with their (decayed) counts, from highest to lowest count.
+        """
+        scale = self._scale()
+        return sorted(((x, self[x] / scale) for x in self._top), key=operator.itemgetter(1), reverse=True)
+
+    def ascii_plot(self, keysort=False, limit=None, out=sys.stdout):
+        """
+        Make a plot in text (ASCII) format of the top entries.
+        """
+        items = self.top_items()
+        if not items:
+            return
+        max_count = items[0][1]
+        items = items[:limit]
+        if keysort:
+            items.sort(key=operator.itemgetter(0))
+        self._write_plot(items, max_count, self._total / self._scale(), out)
+
+
+def split_file(path, range_size=RANGE_SIZE):
+    """
+    Split a file in byte ranges for parallel counting.
+
+    @return list of (start, end) tuples
+    """
+    size = os.path.getsize(path)
+    return [(start, min(start + range_size, size)) for start in range(0, size, range_size)]
+
+
+def count_file_range(path, start, end, observe_lines=False):
+    """
+    Build a histogram of the lines (or words) of a file
+    that start in the given byte range.
+    Together, the ranges of split_file cover each line exactly once.
+
+    @return ObjectHistogram
+    """
+    histogram = ObjectHistogram()
+    # Decode like open(path, 'r') would do.
+    encoding = locale.getpreferredencoding(False)
+    with open(path, 'rb') as f:
+        if start > 0:
+            # Skip the line that started in the previous range.
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            data = f.read(min(BLOCK_SIZE, end - f.tell()))
+            if not data:
+                break
+            if not data.endswith(b'\n'):
+                # Extend to the end of the (last) line.
+                data += f.readline()
+            source = io.StringIO(data.decode(encoding), newline=None)
+            if observe_lines:
+                histogram.observe_lines_from_file(source)
+            else:
+                histogram.observe_words_from_file(source)
+    return histogram
+
+
+def merge_histograms(a, b):
+    """
+    Merge histogram b into histogram a (keeping the order of first observation).
+    """
+    a.update(b)
+    return a
+
+
+def count_from_sources_parallel(sources, observe_lines=False, jobs=2, range_size=RANGE_SIZE):
+    """
+    Build a histogram from a list of sources in a pool of worker processes
+    (map-reduce style), with the same result (including entry order)
+    as ObjectHistogram.observe_from_sources.
+
+    Files are counted per byte range (see split_file) and the partial
+    histograms are merged pairwise (tree reduction), also in the pool.
+    Other sources (file-like objects and paths of non-regular files like pipes)
+    are counted as a whole in the current process.
+
+    @param sources a list of sources: file-like objects or file names
+    @param observe_lines whether lines (instead of words) should be observed
+    @param jobs number of worker processes
+    @param range_size size of the byte ranges to split files in
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        partials = []
+        for source in sources:
+            if isinstance(source, str) and stat.S_ISREG(os.stat(source).st_mode):
+                partials.extend(
+                    executor.submit(count_file_range, source, start, end, observe_lines)
+                    for start, end in split_file(source, range_size)
+                )
+            else:
+                histogram = ObjectHistogram()
+                histogram.observe_from_sources([source], observe_lines=observe_lines)
+                partials.append(histogram)
+        histograms = [p.result() if isinstance(p, concurrent.futures.Future) else p for p in partials]
+
+        while len(histograms) > 1:
+            # Merge adjacent pairs, to preserve the order of first observation.
+            merged = list(executor.map(merge_histograms, histograms[0::2], histograms[1::2]))
+            if len(histograms) % 2:
+                merged.append(histograms[-1])
+            histograms = merged
+    return histograms[0] if histograms else ObjectHistogram()
+
+
+def merge_snapshots(paths):
+    """
+    Sum histogram snapshot files (see ObjectHistogram.write) into one histogram.
+    """
+    histogram = ObjectHistogram()
+    for path in paths:
+        with open(path, 'rb') as f:
+            try:
+                snapshot = ObjectHistogram.read(f)
+            except ValueError as e:
+                raise ValueError('%s: %s' % (path, e))
+        histogram.update(snapshot)
+    return histogram
+
+
+def watch_stream(histogram, fd, observe_lines=False, interval=1.0, keysort=False, out=sys.stdout, clear=True):
+    """
+    Observe a live stream (e.g. a pipe) without blocking on it
+    and redraw the plot of the histogram at a fixed interval, until end of stream.
+
+    @param histogram LiveHistogram (or other ObjectHistogram)
+    @param fd file descriptor to read from
+    @param observe_lines whether lines (instead of words) should be observed
+    @param interval redraw interval in seconds
+    @param clear whether to clear the screen (ANSI escape codes) before each redraw
+    """
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))('surrogateescape')
+    observe = histogram.observe_lines_from_file if observe_lines else histogram.observe_words_from_file
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        # Regular files are always readable (and epoll does not support them).
+        selector = None
+    else:
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+
+    drawn = False
+
+    def redraw():
+        nonlocal drawn
+        if clear:
+            out.write('\x1b[H\x1b[J')
+        elif drawn:
+            # Separate the plots with an empty line.
+            out.write('\n')
+        drawn = True
+        histogram.ascii_plot(keysort=keysort, out=out)
+        out.flush()
+
+    pending = ''
+    next_redraw = time.monotonic() + interval
+    try:
+        while True:
+            if selector is None or selector.select(timeout=max(0, next_redraw - time.monotonic())):
+                data = os.read(fd, BLOCK_SIZE)
+                if not data:
+                    break
+                # Only observe complete lines.
+                lines = (pending + decoder.decode(data)).split('\n')
+                pending = lines.pop()
+                observe([line + '\n' for line in lines])
+            if time.monotonic() >= next_redraw:
+                redraw()
+                next_redraw = time.monotonic() + interval
+    finally:
+        if selector is not None:
+            selector.close()
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        observe([pending])
+    redraw()
+
+
+BINNINGS = ['fixed', 'log', 'quantile']
+
+
+class Bin(collections.namedtuple('Bin', ['low', 'high'])):
+    """
+    Bin (value interval) of a numeric histogram, usable as ObjectHistogram key.
+    """
+
+    def __str__(self):
+        return '%g .. %g' % self
+
+
+class NumericHistogram(object):
+    """
+    Histogram builder for numerical data (requires NumPy).
+
+    Values are parsed in batches into arrays and kept in memory
+    (8 bytes per value), so that bins and percentiles can be
+    computed exactly, in a vectorized way, afterwards.
+    """
+
+    def __init__(self, column=None):
+        """
+        @param column index of the whitespace separated field to take
+            the value from when observing lines (None: whole line)
+        """
+        if numpy is None:
+            raise RuntimeError('Numeric histograms require NumPy, which is not installed.')
+        if column is not None and column < 0:
+            raise ValueError('Invalid column index %d.' % column)
+        self.column = column
+        self.invalid_qty = 0
+        self._arrays = []
+
+    def observe_values(self, values):
+        """
+        Add an array (or sequence) of values.
+        Non-finite values (NaN, infinity) are skipped (and counted as invalid).
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        finite = numpy.isfinite(values)
+        if not finite.all():
+            self.invalid_qty += int(values.size - finite.sum())
+            values = values[finite]
+        self._arrays.append(values)
+
+    def _observe_tokens(self, tokens):
+        try:
+            values = numpy.array(tokens, dtype=numpy.float64)
+        except ValueError:
+            # Slow path: skip tokens that are not numbers.
+            values = []
+            for token in tokens:
+                try:
+                    values.append(float(token))
+                except ValueError:
+                    self.invalid_qty += 1
+        self.observe_values(values)
+
+    def observe_lines_from_file(self, source):
+        """
+        Observe one value per line (or line field) from a file-like source.
+        """
+        source = iter(source)
+        for lines in iter(lambda: list(itertools.islice(source, BATCH_LINES)), []):
+            if self.column is None:
+                tokens = [line.strip() for line in lines]
+            else:
+                fields = [line.split() for line in lines]
+                tokens = [f[self.column] if len(f) > self.column else '' for f in fields]
+            self._observe_tokens(tokens)
+
+    def observe_words_from_file(self, source):
+        """
+        Observe all whitespace separated values from a file-like source.
+        """
+        source = iter(source)
+        for lines in iter(lambda: list(itertools.islice(source, BATCH_LINES)), []):
+            self._observe_tokens(' '.join(lines).split())
+
+    observe_from_sources = ObjectHistogram.observe_from_sources
+
+    def values(self):
+        """
+        Get all observed values as one array.
+        """
+        if len(self._arrays) != 1:
+            self._arrays = [numpy.concatenate(self._arrays or [numpy.empty(0)])]
+        return self._arrays[0]
+
+    def bin_edges(self, bins=20, binning='fixed'):
+        """
+        Compute bin edges for the observed values.
+
+        @param bins number of bins
+        @param binning 'fixed' (equal width), 'log' (equal width on a log scale,
+            with an additional bin for non-positive values) or 'quantile'
+            (about equal number of values per bin)
+        """
+        values = self.values()
+        if binning == 'fixed':
+            edges = numpy.linspace(values.min(), values.max(), bins + 1)
+        elif binning == 'log':
+            positive = values[values > 0]
+            if positive.size == 0:
+                raise ValueError('Log binning requires positive values.')
+            low, high = positive.min(), positive.max()
+            edges = numpy.geomspace(low, high, bins + 1) if low < high else numpy.array([low])
+            if values.min() <= 0:
+                edges = numpy.concatenate([[values.min()], edges])
+        elif binning == 'quantile':
+            edges = numpy.quantile(values, numpy.linspace(0, 1, bins + 1))
+        else:
+            raise ValueError(binning)
+        # Drop duplicate edges (e.g. from ties), but keep at least one bin.
+        edges = numpy.unique(edges)
+        if edges.size < 2:
+            edges = numpy.array([edges[0] - 0.5, edges[0] + 0.5])
+        return edges
+
+    def to_histogram(self, bins=20, binning='fixed'):
+        """
+        Bin the observed values.
+
+        @return ObjectHistogram with Bin keys (in value order)
+        """
+        histogram = ObjectHistogram()
+        values = self.values()
+        if values.size == 0:
+            return histogram
+        counts, edges = numpy.histogram(values, bins=self.bin_edges(bins, binning))
+        for low, high, count in zip(edges[:-1].tolist(), edges[1:].tolist(), counts.tolist()):
+            histogram[Bin(low, high)] = count
+        return histogram
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        Get summary statistics of the observed values.
+
+        @return list of (name, value) tuples
+        """
+        values = self.values()
+        summary = [('count', values.size)]
+        if values.size > 0:
+            summary += [('min', values.min()), ('mean', values.mean())]
+            for p, value in zip(percentiles, numpy.percentile(values, percentiles)):
+                summary.append(('p%g' % p, value))
+            summary.append(('max', values.max()))
+        if self.invalid_qty:
+            summary.append(('invalid', self.invalid_qty))
+        return summary
+
+    def render_summary(self):
+        return '; '.join(
+            ('%s: %g' if isinstance(value, float) else '%s: %d') % (name, value) for name, value in self.summary()
+        )
 
 
 if __name__ == '__main__':
@@ -109,12 +707,112 @@ if __name__ == '__main__':
         dest='keysort', action='store_true', default=False,
         help='Sort the entries on their key, instead of frequency.',
     )
+    arg_parser.add_argument(
+        '-a', '--approximate', metavar='K',
+        dest='approximate', type=int, action='store', default=None,
+        help='Approximate mode with constant memory: only track the (about) K most frequent entries'
+             ' and show lower bounds of their counts.',
+    )
+    arg_parser.add_argument(
+        '--numeric', metavar='BINNING',
+        dest='numeric', choices=BINNINGS, default=None,
+        help='Numeric mode (requires NumPy): bin the values with given binning (%s)'
+             ' and show summary statistics.' % ', '.join(BINNINGS),
+    )
+    arg_parser.add_argument(
+        '-b', '--bins', metavar='N',
+        dest='bins', type=int, action='store', default=20,
+        help='Number of bins in numeric mode.',
+    )
+    arg_parser.add_argument(
+        '-c', '--column', metavar='N',
+        dest='column', type=int, action='store', default=None,
+        help='Numeric mode: take the values from the Nth (1-based) field of each line.',
+    )
+    arg_parser.add_argument(
+        '-j', '--jobs', metavar='N',
+        dest='jobs', type=int, action='store', default=1,
+        help='Number of worker processes to count files with (not in approximate or numeric mode).',
+    )
+    arg_parser.add_argument(
+        '--save', metavar='PATH',
+        dest='save', action='store', default=None,
+        help='Save a snapshot of the histogram, to be merged later with --merge.',
+    )
+    arg_parser.add_argument(
+        '--merge',
+        dest='merge', action='store_true', default=False,
+        help='Merge (sum) the histogram snapshots at the given paths instead of observing data.',
+    )
+    arg_parser.add_argument(
+        '--live',
+        dest='live', action='store_true', default=False,
+        help='Live mode: observe the standard input as it comes in and redraw the top entries periodically.',
+    )
+    arg_parser.add_argument(
+        '--interval', metavar='SECONDS',
+        dest='interval', type=float, action='store', default=1.0,
+        help='Redraw interval in live mode.',
+    )
+    arg_parser.add_argument(
+        '--half-life', metavar='SECONDS',
+        dest='half_life', type=float, action='store', default=None,
+        help='Live mode: let observations decay exponentially with given half-life.',
+    )
 
     arguments = arg_parser.parse_args()
     paths = list(arguments.path) if arguments.path else [sys.stdin]
 
-    histogram = ObjectHistogram()
+    if arguments.jobs > 1 and (arguments.approximate or arguments.numeric):
+        arg_parser.error('Option --jobs is not supported in approximate or numeric mode.')
+    if (arguments.save or arguments.merge) and (arguments.approximate or arguments.numeric):
+        arg_parser.error('Options --save and --merge are not supported in approximate or numeric mode.')
+    if arguments.column is not None and arguments.column < 1:
+        arg_parser.error('Option --column requires a (1-based) field number of at least 1.')
+    if arguments.merge and not arguments.path:
+        arg_parser.error('Option --merge requires snapshot paths.')
+    if arguments.live and (
+            arguments.path or arguments.approximate or arguments.numeric or arguments.jobs > 1
+            or arguments.save or arguments.merge
+    ):
+        arg_parser.error('Live mode only reads the standard input and does not support'
+                         ' approximate, numeric, --jobs, --save or --merge mode.')
+
+    if arguments.live:
+        histogram = LiveHistogram(limit=arguments.limit or 20, half_life=arguments.half_life)
+        try:
+            watch_stream(
+                histogram, sys.stdin.fileno(), observe_lines=arguments.observe_lines,
+                interval=arguments.interval, keysort=arguments.keysort, clear=sys.stdout.isatty()
+            )
+        except KeyboardInterrupt:
+            pass
+    elif arguments.numeric:
+        if numpy is None:
+            arg_parser.error('Numeric mode requires NumPy, which is not installed.')
+        numeric = NumericHistogram(column=arguments.column - 1 if arguments.column is not None else None)
+        numeric.observe_from_sources(paths, observe_lines=arguments.observe_lines or arguments.column is not None)
+        histogram = numeric.to_histogram(bins=arguments.bins, binning=arguments.numeric)
+        # Bins are always plotted in value order.
+        histogram.ascii_plot(limit=arguments.limit, keysort=True)
+        print(numeric.render_summary())
+    else:
+        if arguments.approximate:
+            histogram = HeavyHitterHistogram(arguments.approximate)
+            histogram.observe_from_sources(paths, observe_lines=arguments.observe_lines)
+        elif arguments.merge:
+            try:
+                histogram = merge_snapshots(paths)
+            except ValueError as e:
+                arg_parser.error(str(e))
+        elif arguments.jobs > 1:
+            histogram = count_from_sources_parallel(paths, observe_lines=arguments.observe_lines, jobs=arguments.jobs)
+        else:
+            histogram = ObjectHistogram()
+            histogram.observe_from_sources(paths, observe_lines=arguments.observe_lines)
 
-    histogram.observe_from_sources(paths, observe_lines=arguments.observe_lines)
+        if arguments.save:
+            with open(arguments.save, 'wb') as f:
+                histogram.write(f)
 
-    histogram.ascii_plot(limit=arguments.limit, keysort=arguments.keysort)
+        histogram.ascii_plot(limit=arguments.limit, keysort=arguments.keysort)
@@ -0,0 +1,467 @@
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import duplicate_searcher
+from duplicate_searcher import group_on_content_hash, HEAD_BLOCK_SIZE, full_digest, DigestCache, \
+    group_on_content, get_file_entry, compare_contents, scan_files, group_on_filesize, collapse_hard_links, \
+    benchmark_algorithms, iter_content_groups, JsonLinesReportWriter, CsvReportWriter, TextReportWriter, \
+    find_duplicate_directories, exclude_directories, remove_small_groups, \
+    sort_size_groups, ExternalSizeIndex, FileEntry, Deduplicator, \
+    write_index, merge_indexes, open_index, LiveDuplicateIndex, watch_duplicates, Inotify
+
+
+@pytest.fixture
+def make_file(tmp_path):
+    def make_file(name, content):
+        path = tmp_path / name
+        path.write_bytes(content)
+        return get_file_entry(str(path))
+
+    return make_file
+
+
+def test_group_on_content_hash_small_files(make_file):
+    a = make_file('a', b'hello')
+    b = make_file('b', b'hello')
+    c = make_file('c', b'world')
+    groups = group_on_content_hash([a, b, c], size=5)
+    assert groups == {full_digest(a.path): [a, b]}
+
+
+def test_group_on_content_hash_shared_header(make_file):
+    header = b'x' * (2 * HEAD_BLOCK_SIZE)
+    a = make_file('a', header + b'1' * 10000)
+    b = make_file('b', header + b'2' * 10000)
+    c = make_file('c', header + b'1' * 10000)
+    groups = group_on_content_hash([a, b, c], size=len(header) + 10000)
+    assert groups == {full_digest(a.path): [a, c]}
+
+
+def test_group_on_content_hash_same_head_and_tail(make_file):
+    content = bytearray(b'x' * (1024 * 1024))
+    a = make_file('a', bytes(content))
+    content[500000] = ord('y')
+    b = make_file('b', bytes(content))
+    assert group_on_content_hash([a, b], size=len(content)) == {}
+
+
+def test_group_on_content_hash_unknown_size(make_file):
+    a = make_file('a', b'hello world' * 1000)
+    b = make_file('b', b'hello world' * 1000)
+    assert group_on_content_hash([a, b]) == {full_digest(a.path): [a, b]}
+
+
+def test_digest_cache(make_file, tmp_path):
+    a = make_file('a', b'hello')
+    cache = DigestCache(str(tmp_path / 'cache.sqlite'))
+    assert cache.get(a, 'full_digest') is None
+    cache.put(a, 'full_digest', 'abc')
+    assert cache.get(a, 'full_digest') == 'abc'
+    assert cache.get(a, 'head_digest') is None
+    cache.close()
+
+    # Cache persists between sessions, but entries of modified files are evicted.
+    cache = DigestCache(str(tmp_path / 'cache.sqlite'))
+    assert cache.get(a, 'full_digest') == 'abc'
+    a = make_file('a', b'hello world')
+    assert cache.get(a, 'full_digest') is None
+    cache.close()
+
+
+def test_digest_cache_evicts_unused_entries(make_file, tmp_path, monkeypatch):
+    now = [1000000]
+    monkeypatch.setattr(duplicate_searcher.time, 'time', lambda: now[0])
+    a = make_file('a', b'hello')
+    b = make_file('b', b'world')
+    path = str(tmp_path / 'cache.sqlite')
+    cache = DigestCache(path)
+    cache.put(a, 'full_digest', 'abc')
+    cache.put(b, 'full_digest', 'def')
+    cache.close()
+
+    # Unused entries are kept up to the maximum age.
+    now[0] += 3600
+    cache = DigestCache(path, max_age=3600)
+    cache.close()
+    now[0] += 1
+    cache = DigestCache(path, max_age=3600)
+    assert cache.get(a, 'full_digest') == 'abc'
+    cache.close()
+    cache = DigestCache(path, max_age=3600)
+    assert cache.get(a, 'full_digest') == 'abc'
+    assert cache.get(b, 'full_digest') is None
+    cache.close()
+
+
+def test_group_on_content_with_cache_no_rereads(make_file, tmp_path, monkeypatch):
+    a = make_file('a', b'x' * 100000)
+    b = make_file('b', b'x' * 100000)
+    expected = [(100000, full_digest(a.path), [a, b])]
+    cache = DigestCache(str(tmp_path / 'cache.sqlite'))
+    assert group_on_content({100000: [a, b]}, cache=cache, compare_threshold=3) == expected
+    cache.close()
+
+    opened = []
+
+    def counting_open(path, *args, **kwargs):
+        opened.append(path)
+        return open(path, *args, **kwargs)
+
+    monkeypatch.setattr(duplicate_searcher, 'open', counting_open, raising=False)
+    cache = DigestCache(str(tmp_path / 'cache.sqlite'))
+    assert group_on_content({100000: [a, b]}, cache=cache, compare_threshold=3) == expected
+    cache.close()
+    assert opened == []
+
+
+def test_group_on_content_hash_with_cache(make_file, tmp_path):
+    a = make_file('a', b'hello')
+    b = make_file('b', b'hello')
+    cache = DigestCache(str(tmp_path / 'cache.sqlite'))
+    expected = {full_digest(a.path): [a, b]}
+    assert group_on_content_hash([a, b], size=5, cache=cache) == expected
+    assert group_on_content_hash([a, b], size=5, cache=cache) == expected
+    cache.close()
+
+
+@pytest.mark.parametrize('executor_class', [
+    concurrent.futures.ThreadPoolExecutor,
+    concurrent.futures.ProcessPoolExecutor,
+])
+def test_group_on_content_parallel(make_file, executor_class):
+    size_groups = {}
+    for i in range(20):
+        content = (b'%02d' % (i % 7)) * (i * 1000 + 1)
+        size_groups.setdefault(len(content), []).extend([
+            make_file('a%d' % i, content),
+            make_file('b%d' % i, content[:-1] + b'x'),
+            make_file('c%d' % i, content),
+        ])
+    expected = group_on_content(size_groups)
+    assert len(expected) == 20
+    with executor_class(max_workers=3) as executor:
+        assert group_on_content(size_groups, executor=executor, max_in_flight=5) == expected
+
+
+def test_scan_files(make_file, tmp_path):
+    a = make_file('a', b'hello')
+    os.mkdir(str(tmp_path / 'sub'))
+    b = make_file('sub/b', b'hello')
+    os.link(a.path, str(tmp_path / 'sub' / 'c'))
+    os.symlink(a.path, str(tmp_path / 'd'))
+    os.mkfifo(str(tmp_path / 'e'))
+    entries = list(scan_files([str(tmp_path)]))
+    assert sorted(e.path for e in entries) == sorted([a.path, b.path, str(tmp_path / 'sub' / 'c')])
+    size_groups = group_on_filesize(entries)
+    assert list(size_groups.keys()) == [5]
+    # Files of a directory are listed before its subdirectories.
+    assert [e.path for e in collapse_hard_links(size_groups[5])] == [a.path, b.path]
+
+
+def test_compare_contents(make_file):
+    a = make_file('a', b'x' * 100000)
+    b = make_file('b', b'x' * 99999 + b'y')
+    c = make_file('c', b'x' * 100000)
+    d = make_file('d', b'y' * 100000)
+    assert compare_contents([a.path, b.path, c.path, d.path]) == [[a.path, c.path]]
+    assert compare_contents([a.path, b.path], first_chunk_size=10, chunk_size=1000) == []
+    assert compare_contents([a.path, c.path], first_chunk_size=10, chunk_size=1000) == [[a.path, c.path]]
+
+
+def test_group_on_content_compare_threshold(make_file):
+    a = make_file('a', b'hello')
+    b = make_file('b', b'hello')
+    c = make_file('c', b'world')
+    d = make_file('d', b'hi')
+    e = make_file('e', b'hi')
+    size_groups = {5: [a, b, c], 2: [d, e]}
+    assert group_on_content(size_groups, compare_threshold=2) == [
+        (2, None, [d, e]),
+        (5, full_digest(a.path), [a, b]),
+    ]
+
+
+@pytest.mark.parametrize('algorithm', ['md5', 'sha1', 'sha256', 'blake2b'])
+def test_group_on_content_hash_algorithm(make_file, tmp_path, algorithm):
+    a = make_file('a', b'hello world' * 1000)
+    b = make_file('b', b'hello world' * 1000)
+    expected = {hashlib.new(algorithm, b'hello world' * 1000).hexdigest(): [a, b]}
+    assert group_on_content_hash([a, b], algorithm=algorithm) == expected
+    cache = DigestCache(str(tmp_path / 'cache.sqlite'))
+    assert group_on_content_hash([a, b], algorithm=algorithm, cache=cache) == expected
+    assert group_on_content_hash([a, b], algorithm=algorithm, cache=cache) == expected
+    cache.close()
+
+
+def test_benchmark_algorithms():
+    results = benchmark_algorithms(['md5', 'blake2b'], total_size=1024)
+    assert [a for a, t in results] == ['md5', 'blake2b']
+    assert all(t > 0 for a, t in results)
+
+
+def test_iter_content_groups_largest_first(make_file):
+    size_groups = {}
+    for size in [10, 30000, 200]:
+        size_groups[size] = [make_file('%s-%d' % (size, i), b'x' * size) for i in range(2)]
+    groups = list(iter_content_groups(sort_size_groups(size_groups), batch_size=3))
+    assert [size for size, hash, group in groups] == [30000, 200, 10]
+    assert [group for size, hash, group in groups] == [size_groups[30000], size_groups[200], size_groups[10]]
+
+
+def test_report_writers(make_file):
+    a = make_file('a', b'hello')
+    b = make_file('b', b'hello')
+
+    out = io.StringIO()
+    report = JsonLinesReportWriter(algorithm='sha1', out=out)
+    report.write_group(5, 'abc', [a, b])
+    report.write_group(5, None, [a, b])
+    report.close()
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == [
+        {'type': 'files', 'size': 5, 'algorithm': 'sha1', 'hash': 'abc', 'paths': [a.path, b.path]},
+        {'type': 'files', 'size': 5, 'algorithm': None, 'hash': None, 'paths': [a.path, b.path]},
+    ]
+
+    out = io.StringIO()
+    report = CsvReportWriter(algorithm='sha1', out=out)
+    report.write_group(5, 'abc', [a, b])
+    report.close()
+    assert out.getvalue().splitlines() == [
+        'group,type,size,algorithm,hash,path',
+        '0,file,5,sha1,abc,' + a.path,
+        '0,file,5,sha1,abc,' + b.path,
+    ]
+
+    out = io.StringIO()
+    report = TextReportWriter(out=out)
+    report.close()
+    assert out.getvalue() == 'No duplicates found\n'
+
+
+def test_find_duplicate_directories(make_file, tmp_path):
+    for top in ['one', 'two', 'three']:
+        os.makedirs(str(tmp_path / top / 'sub' / 'deeper'))
+        make_file(top + '/sub/a', b'hello')
+        make_file(top + '/sub/deeper/b', b'world')
+        make_file(top + '/c', b'foo')
+    # Only the "sub" directory of "three" is identical.
+    make_file('three/c', b'bar')
+    make_file('loose', b'hello')
+
+    root = str(tmp_path)
+    entries = list(scan_files([root]))
+    size_groups = remove_small_groups(group_on_filesize(entries))
+    content_groups = list(iter_content_groups(sort_size_groups(size_groups)))
+    directory_groups = find_duplicate_directories(entries, [root], content_groups)
+    assert [(size, paths) for size, hash, paths in directory_groups] == [
+        (13, [os.path.join(root, 'one'), os.path.join(root, 'two')]),
+        (10, [os.path.join(root, 'one', 'sub'), os.path.join(root, 'three', 'sub'),
+              os.path.join(root, 'two', 'sub')]),
+    ]
+
+    matched = set(p for g in directory_groups for p in g[2])
+    remaining = [[f.path for f in group] for size, hash, group in exclude_directories(content_groups, matched)]
+    assert remaining == [[os.path.join(root, 'one', 'sub', 'a'), os.path.join(root, 'loose')]]
+
+
+def test_external_size_index(tmp_path):
+    entries = [FileEntry('/data/f%d' % i, (i * 7) % 13, 1, i, 0) for i in range(100)]
+    index = ExternalSizeIndex(memory_budget=2000, tempdir=str(tmp_path))
+    for entry in entries:
+        index.add(entry)
+    assert len(index._runs) > 5
+    groups = list(index.iter_size_groups())
+    index.close()
+    assert groups == sort_size_groups(group_on_filesize(entries))
+
+
+@pytest.mark.parametrize('dry_run', [False, True])
+def test_deduplicator(make_file, dry_run):
+    a = make_file('a', b'hello' * 1000)
+    b = make_file('b', b'hello' * 1000)
+    c = make_file('c', b'hello' * 1000)
+    log = io.StringIO()
+    deduplicator = Deduplicator(dry_run=dry_run, log=log)
+    groups = [(5000, 'abc', [a, b, c])]
+    assert list(deduplicator.iter_deduplicated(groups)) == groups
+    assert deduplicator.reclaimed == 10000
+    for entry in [a, b, c]:
+        with open(entry.path, 'rb') as f:
+            assert f.read() == b'hello' * 1000
+    if dry_run:
+        assert log.getvalue().startswith('Would deduplicate')
+        assert len(set(os.stat(e.path).st_ino for e in [a, b, c])) == 3
+    else:
+        assert 'Deduplicated' in log.getvalue()
+
+
+def test_deduplicator_skips_changed_files(make_file):
+    a = make_file('a', b'hello')
+    b = make_file('b', b'hello')
+    make_file('b', b'world!')
+    deduplicator = Deduplicator(log=io.StringIO())
+    deduplicator.dedupe_group(5, [a, b])
+    assert deduplicator.reclaimed == 0
+    with open(b.path, 'rb') as f:
+        assert f.read() == b'world!'
+
+
+def test_deduplicator_hard_link_verification(make_file, monkeypatch):
+    def unsupported(*args):
+        raise OSError(95, 'Operation not supported')
+
+    monkeypatch.setattr(duplicate_searcher, 'dedupe_file_range', unsupported)
+    a = make_file('a', b'hello')
+    # Same (colliding) hash, different content.
+    b = make_file('b', b'world')
+    # Same content, different mode.
+    c = make_file('c', b'hello')
+    os.chmod(c.path, 0o600)
+    c = get_file_entry(c.path)
+    d = make_file('d', b'hello')
+    log = io.StringIO()
+    deduplicator = Deduplicator(log=log)
+    deduplicator.dedupe_group(5, [a, b, c, d])
+    assert deduplicator.reclaimed == 5
+    assert 'b: content differs' in log.getvalue()
+    assert 'c: mode, owner or group differs' in log.getvalue()
+    with open(b.path, 'rb') as f:
+        assert f.read() == b'world'
+    assert os.stat(c.path).st_mode & 0o777 == 0o600
+    assert os.stat(d.path).st_ino == os.stat(a.path).st_ino
+    assert os.stat(b.path).st_ino != os.stat(a.path).st_ino
+
+
+def test_write_and_merge_indexes(make_file, tmp_path):
+    big = b'x' * 2 * HEAD_BLOCK_SIZE
+    a = make_file('a', b'hello')
+    b = make_file('b', big + b'1')
+    c = make_file('c', big + b'2')
+    d = make_file('d', b'world')
+    e = make_file('e', big + b'1')
+    index_one = str(tmp_path / 'one.idx.gz')
+    with open_index(index_one, 'wt') as f:
+        write_index(sort_size_groups(group_on_filesize([a, b, c])), f, node='one', batch_size=2)
+    index_two = str(tmp_path / 'two.idx')
+    with open_index(index_two, 'wt') as f:
+        write_index(sort_size_groups(group_on_filesize([d, e])), f, node='two')
+    with open_index(index_two, 'rt') as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[0]['node'] == 'two'
+    # No full digest for large file without local candidate.
+    assert lines[1] == [len(big) + 1, lines[1][1], None, e.path]
+    assert lines[2] == [5, full_digest(d.path), full_digest(d.path), d.path]
+
+    # Full digests missing, file is on other node: unconfirmed.
+    merged = list(merge_indexes([index_one, index_two], node='three'))
+    assert [(s, h.startswith('partial:'), [f.path for f in g]) for s, h, g in merged] == [
+        (len(big) + 1, True, ['one:' + b.path, 'one:' + c.path, 'two:' + e.path]),
+    ]
+    # Missing full digests can be calculated on the local node.
+    merged = list(merge_indexes([index_one, index_two], node='two'))
+    assert [(s, h, [f.path for f in g]) for s, h, g in merged] == [
+        (len(big) + 1, full_digest(b.path), ['one:' + b.path, 'two:' + e.path]),
+    ]
+
+
+def test_live_duplicate_index(make_file):
+    a = make_file('a', b'hello')
+    b = make_file('b', b'world')
+    index = LiveDuplicateIndex()
+    assert index.add(a, check=False) is None
+    assert index.add(b) is None
+    c = make_file('c', b'hello')
+    assert index.add(c) == (5, full_digest(a.path), [a, c])
+    index.remove(a.path)
+    d = make_file('d', b'hello')
+    assert index.add(d) == (5, full_digest(a.path), [c, d])
+    index.remove_tree(os.path.dirname(a.path))
+    assert len(index) == 0
+
+
+def test_live_duplicate_index_stale_entry(make_file):
+    stale = make_file('stale', b'xxxxx')
+    index = LiveDuplicateIndex()
+    index.add(stale, check=False)
+    new1 = make_file('new1', b'hello')
+    os.remove(stale.path)
+    assert index.add(new1) is None
+    assert len(index) == 1
+    new2 = make_file('new2', b'hello')
+    assert index.add(new2) == (5, full_digest(new1.path), [new1, new2])
+
+
+def test_live_duplicate_index_evicts_digests(make_file):
+    a = make_file('a', b'hello')
+    b = make_file('b', b'hello')
+    index = LiveDuplicateIndex()
+    index.add(a, check=False)
+    index.add(b)
+    assert len(index.cache._digests) == 2
+    index.remove(a.path)
+    index.remove_tree(os.path.dirname(b.path))
+    assert index.cache._digests == {}
+
+
+def test_watch_duplicates_overflow(make_file, tmp_path):
+    make_file('a', b'hello')
+    stale = make_file('stale', b'xxxxx')
+
+    class OverflowingInotify(object):
+        events = [[(-1, duplicate_searcher.IN_Q_OVERFLOW, 0, '')]]
+
+        def add_watch(self, path, mask):
+            return 1
+
+        def rm_watch(self, wd):
+            pass
+
+        def read_events(self, timeout=None):
+            if not self.events:
+                return []
+            # Changes that are lost in the overflow.
+            os.remove(stale.path)
+            make_file('b', b'hello')
+            make_file('c', b'world')
+            make_file('d', b'world')
+            return self.events.pop()
+
+        def close(self):
+            pass
+
+    out = io.StringIO()
+    watch_duplicates([str(tmp_path)], JsonLinesReportWriter(out=out), timeout=1, inotify=OverflowingInotify())
+    assert sorted(json.loads(line)['paths'] for line in out.getvalue().splitlines()) == [
+        [str(tmp_path / 'a'), str(tmp_path / 'b')],
+        [str(tmp_path / 'c'), str(tmp_path / 'd')],
+    ]
+
+
+def test_watch_duplicates(make_file, tmp_path):
+    make_file('a', b'hello')
+    os.mkdir(str(tmp_path / 'sub'))
+    out = io.StringIO()
+    report = JsonLinesReportWriter(out=out)
+    inotify = Inotify()
+
+    def changes():
+        time.sleep(0.2)
+        os.mkdir(str(tmp_path / 'sub' / 'new'))
+        time.sleep(0.2)
+        make_file('sub/new/b', b'hello')
+        make_file('sub/c', b'world')
+
+    thread = threading.Thread(target=changes)
+    thread.start()
+    watch_duplicates([str(tmp_path)], report, timeout=1, inotify=inotify)
+    thread.join()
+    assert [json.loads(line)['paths'] for line in out.getvalue().splitlines()] == [
+        [str(tmp_path / 'a'), str(tmp_path / 'sub' / 'new' / 'b')],
+    ]
@@ -0,0 +1,250 @@
+import bz2
+import gzip
+import lzma
+import os
+import random
+
+import pytest
+
+from filelinestats import median, histogram_quantile, LineStats, FileSizeStat, get_lines, \
+    generate_file_size_stats, sniff_binary, collect_line_stats, BinaryFileError, get_sort_key, \
+    top_stats, AggregateStats, detect_compression, StatsCache
+
+
+@pytest.mark.parametrize(['values', 'expected'], [
+    ([1], 1),
+    ([3, 1, 2], 2),
+    ([4, 1, 3, 2], 2.5),
+    ([5, 5, 1, 1], 3.0),
+])
+def test_median(values, expected):
+    assert median(values) == expected
+
+
+def test_histogram_quantile_median():
+    rng = random.Random(42)
+    for n in range(1, 50):
+        values = [rng.randint(0, 10) for _ in range(n)]
+        histogram = {}
+        for v in values:
+            histogram[v] = histogram.get(v, 0) + 1
+        assert histogram_quantile(histogram, 0.5) == median(values)
+    assert histogram_quantile({}, 0.5) is None
+
+
+@pytest.mark.parametrize('block_size', [1, 3, 7, 1000])
+def test_line_stats_blocks(block_size):
+    text = 'hello\n\n  \nworld!!\nlast'
+    stats = LineStats()
+    for i in range(0, len(text), block_size):
+        stats.feed(text[i:i + block_size])
+    stats.close()
+    assert stats.line_qty == 5
+    assert stats.non_empty_line_qty == 3
+    assert stats.max_length == 8
+    assert stats.average_length == (6 + 1 + 3 + 8 + 4) / 5
+    assert stats.median_length == 4
+
+
+def test_line_stats_long_lines():
+    stats = LineStats()
+    for block in ['  ', ' \t', '', ' \nab', 'c' * 1000, 'd\n  ', 'x']:
+        stats.feed(block)
+    assert not hasattr(stats, '_partial')
+    stats.close()
+    assert sorted(stats.length_histogram.elements()) == [3, 6, 1004]
+    assert stats.non_empty_line_qty == 2
+
+
+def test_file_size_stat(tmp_path):
+    path = tmp_path / 'file.txt'
+    path.write_text('hello\r\n\nworld!!\n')
+    stat = FileSizeStat(str(path))
+    assert stat.line_qty == 3
+    assert stat.non_empty_line_qty == 2
+    assert stat.max_length == 8
+    assert stat.median_length == 6
+    assert stat.empty_line_fraction == pytest.approx(1 / 3)
+    assert [len(l) for l in get_lines(str(path))] == [6, 1, 8]
+
+
+def test_file_size_stat_empty(tmp_path):
+    path = tmp_path / 'file.txt'
+    path.write_text('')
+    stat = FileSizeStat(str(path))
+    assert stat.line_qty == 0
+    assert stat.median_length is None
+    assert 'lineqty:     0' in stat.render()
+
+
+@pytest.mark.parametrize(['jobs', 'ordered'], [(1, True), (3, True), (3, False)])
+def test_generate_file_size_stats(tmp_path, jobs, ordered):
+    paths = []
+    for i in range(50):
+        path = tmp_path / ('file%02d.txt' % i)
+        path.write_text('x\n' * i)
+        paths.append(str(path))
+    stats = list(generate_file_size_stats(iter(paths), jobs=jobs, ordered=ordered, chunk_size=3))
+    if ordered:
+        assert [s.filename for s in stats] == paths
+    else:
+        assert sorted(s.filename for s in stats) == paths
+    assert sorted(s.line_qty for s in stats) == list(range(50))
+
+
+@pytest.mark.parametrize(['head', 'expected'], [
+    (b'', None),
+    (b'hello world\n\tindented\r\n', None),
+    ('h\u00e9llo w\u00f6rld\n'.encode('utf-8'), None),
+    (b'\x89PNG\r\n\x1a\n\x00\x00', 'PNG image'),
+    (b'\x1f\x8b\x08\x00', 'gzip data'),
+    (b'hello\x00world', 'NUL bytes'),
+    (b'ab\x01\x02\x03\x04', 'control characters'),
+])
+def test_sniff_binary(head, expected):
+    assert sniff_binary(head) == expected
+
+
+def test_binary_file(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(b'\x7fELF' + bytes(range(256)) * 100)
+    with pytest.raises(BinaryFileError):
+        collect_line_stats(str(path))
+    stat = FileSizeStat(str(path))
+    assert stat.binary == 'ELF executable'
+    assert stat.line_qty is None
+    assert stat.render() == 'binary: ELF executable; ' + str(path)
+
+
+def test_sort_key_none_first(tmp_path):
+    (tmp_path / 'a').write_text('hello\n')
+    (tmp_path / 'b').write_bytes(b'\x00\x01')
+    (tmp_path / 'c').write_text('')
+    stats = [FileSizeStat(str(tmp_path / n)) for n in 'abc']
+    stats.sort(key=get_sort_key('max_length'))
+    assert [s.filename[-1] for s in stats] == ['b', 'c', 'a']
+
+
+def test_top_stats(tmp_path):
+    stats = []
+    for i in [3, 9, 1, 7, 5]:
+        path = tmp_path / ('file%d.txt' % i)
+        path.write_text('x\n' * i)
+        stats.append(FileSizeStat(str(path)))
+    top = top_stats(iter(stats), 3, 'line_qty')
+    assert [s.line_qty for s in top] == [5, 7, 9]
+    assert top_stats(iter(stats), 10, 'line_qty') == sorted(stats, key=get_sort_key('line_qty'))
+
+
+def test_aggregate_stats(tmp_path):
+    (tmp_path / 'a').write_text('a\nbb\nccc\n')
+    (tmp_path / 'b').write_text('dddd\n\n')
+    (tmp_path / 'c').write_bytes(b'\x00\x01')
+    stats = [FileSizeStat(str(tmp_path / n), keep_histogram=True) for n in 'abc']
+
+    one = AggregateStats()
+    one.add(stats[0])
+    two = AggregateStats()
+    two.add(stats[1])
+    two.add(stats[2])
+    one.merge(AggregateStats.from_json(two.to_json()))
+
+    assert (one.file_qty, one.binary_qty, one.line_qty, one.non_empty_line_qty) == (3, 1, 5, 4)
+    assert one.quantile(0.5) == median([2, 3, 4, 5, 1])
+    assert one.quantile(0.99) == pytest.approx(4.96)
+    assert 'p95len: 4.8' in one.render()
+
+
+@pytest.mark.parametrize(['compress', 'expected'], [
+    (gzip.compress, 'gzip'),
+    (bz2.compress, 'bzip2'),
+    (lzma.compress, 'xz'),
+    (lambda data: data, None),
+])
+def test_compressed_file(tmp_path, compress, expected):
+    text = 'hello\n\nworld!!\n' * 10000
+    data = compress(text.encode('utf-8'))
+    assert detect_compression(data[:100]) == expected
+    path = tmp_path / 'file'
+    path.write_bytes(data)
+    stat = FileSizeStat(str(path))
+    assert stat.binary is None
+    assert (stat.line_qty, stat.non_empty_line_qty, stat.max_length) == (30000, 20000, 8)
+
+
+def test_text_with_magic_prefix(tmp_path):
+    for name, text in [('mz.txt', 'MZ is a postal code\n'), ('bz.txt', 'BZh what?\n')]:
+        path = tmp_path / name
+        path.write_text(text)
+        stat = FileSizeStat(str(path))
+        assert stat.binary is None
+        assert stat.line_qty == 1
+    path = tmp_path / 'file.bz2'
+    path.write_bytes(bz2.compress(b'\x00' * 100))
+    assert FileSizeStat(str(path), decompress=False).binary == 'bzip2 data'
+
+
+def test_compressed_file_multi_member_gzip(tmp_path):
+    path = tmp_path / 'file.gz'
+    path.write_bytes(gzip.compress(b'hello\n') + gzip.compress(b'world\n'))
+    assert FileSizeStat(str(path)).line_qty == 2
+
+
+def test_compressed_file_no_decompress(tmp_path):
+    path = tmp_path / 'file.gz'
+    path.write_bytes(gzip.compress(b'hello\n'))
+    assert FileSizeStat(str(path), decompress=False).binary == 'gzip data'
+
+
+def test_compressed_binary_file(tmp_path):
+    path = tmp_path / 'file.gz'
+    path.write_bytes(gzip.compress(b'\x00\x01' * 100))
+    assert FileSizeStat(str(path)).binary == 'NUL bytes'
+    path.write_bytes(gzip.compress(b'hello\n' * 100)[:30])
+    assert FileSizeStat(str(path)).binary == 'invalid gzip data'
+
+
+def test_stats_cache(tmp_path, monkeypatch):
+    a = tmp_path / 'a.txt'
+    a.write_text('hello\n\nworld!!\n')
+    b = tmp_path / 'b.txt'
+    b.write_bytes(b'\x00\x01')
+    paths = [str(a), str(b)]
+    cache_path = str(tmp_path / 'cache.sqlite')
+
+    cache = StatsCache(cache_path)
+    first = [s.to_fields() for s in generate_file_size_stats(paths, cache=cache, keep_histogram=True)]
+    cache.close()
+
+    # Unchanged files are served from the cache.
+    import filelinestats
+    monkeypatch.setattr(filelinestats, 'collect_line_stats', None)
+    cache = StatsCache(cache_path)
+    assert [s.to_fields() for s in generate_file_size_stats(paths, cache=cache, keep_histogram=True)] == first
+    assert [s.filename for s in generate_file_size_stats(paths, cache=cache)] == paths
+    cache.close()
+    monkeypatch.undo()
+
+    # Modified files are collected again.
+    a.write_text('hello\n')
+    os.utime(str(a), ns=(0, 0))
+    cache = StatsCache(cache_path)
+    stats = list(generate_file_size_stats(paths, cache=cache))
+    cache.close()
+    assert stats[0].line_qty == 1
+    assert stats[1].binary == 'NUL bytes'
+
+
+def test_stats_cache_eviction(tmp_path):
+    paths = []
+    for i in range(5):
+        path = tmp_path / ('%d.txt' % i)
+        path.write_text('x\n' * i)
+        paths.append(str(path))
+    cache_path = str(tmp_path / 'cache.sqlite')
+    cache = StatsCache(cache_path, max_entries=3)
+    list(generate_file_size_stats(paths, cache=cache))
+    cache.close()
+    cache = StatsCache(cache_path)
+    assert sum(cache.get(path, {})[0] is not None for path in paths) == 3
+    cache.close()
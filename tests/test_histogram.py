@@ -0,0 +1,257 @@
+import collections
+import io
+import os
+import random
+import threading
+
+import pytest
+
+from histogram import ObjectHistogram, HeavyHitterHistogram, NumericHistogram, Bin, count_from_sources_parallel, \
+    merge_snapshots, LiveHistogram, watch_stream
+
+
+def test_observe():
+    histogram = ObjectHistogram()
+    for x in 'abacab':
+        histogram.observe(x)
+    assert histogram == {'a': 3, 'b': 2, 'c': 1}
+    assert histogram.ordered_items() == [('a', 3), ('b', 2), ('c', 1)]
+
+
+def test_observe_words_from_file(monkeypatch):
+    monkeypatch.setattr('histogram.BATCH_LINES', 2)
+    histogram = ObjectHistogram()
+    histogram.observe_words_from_file(io.StringIO('foo bar\nbar\n\nbaz  bar foo\nfoo'))
+    assert histogram == {'foo': 3, 'bar': 3, 'baz': 1}
+    # Line boundaries are word boundaries, also without trailing newlines.
+    histogram.observe_words_from_file(['foo', 'bar'])
+    assert histogram == {'foo': 4, 'bar': 4, 'baz': 1}
+
+
+def test_observe_from_sources(tmp_path):
+    path = tmp_path / 'words.txt'
+    path.write_text('foo bar\nfoo bar\nbaz\n')
+    words = ObjectHistogram()
+    words.observe_from_sources([str(path), io.StringIO('foo')])
+    assert words.ordered_items() == [('foo', 3), ('bar', 2), ('baz', 1)]
+    lines = ObjectHistogram()
+    lines.observe_from_sources([str(path)], observe_lines=True)
+    assert lines.ordered_items() == [('foo bar\n', 2), ('baz\n', 1)]
+
+
+def test_ascii_plot():
+    histogram = ObjectHistogram()
+    histogram.update('aaaabbc')
+    out = io.StringIO()
+    histogram.ascii_plot(limit=2, out=out)
+    assert out.getvalue().splitlines() == [
+        '#' * 20 + '     4 (57.14%) a',
+        '%20s     2 (28.57%%) b' % ('#' * 10),
+    ]
+    out = io.StringIO()
+    histogram.ascii_plot(keysort=True, out=out)
+    assert [line.split()[-1] for line in out.getvalue().splitlines()] == ['a', 'b', 'c']
+    out = io.StringIO()
+    ObjectHistogram().ascii_plot(out=out)
+    assert out.getvalue() == ''
+
+
+def test_heavy_hitter_histogram():
+    random.seed(42)
+    stream = ['a'] * 1000 + ['b'] * 500 + ['c'] * 300 + ['x%d' % i for i in range(2000)]
+    random.shuffle(stream)
+    exact = collections.Counter(stream)
+    histogram = HeavyHitterHistogram(50)
+    histogram.observe_lines_from_file(stream[:1000])
+    for x in stream[1000:]:
+        histogram.observe(x)
+    assert len(histogram) == 50
+    assert sum(histogram.values()) == len(stream)
+    assert [x for x, _ in histogram.ordered_items()[:3]] == ['a', 'b', 'c']
+    for x, count in histogram.items():
+        assert count - histogram.errors[x] <= exact[x] <= count
+        assert histogram.errors[x] <= len(stream) / 50
+    out = io.StringIO()
+    histogram.ascii_plot(limit=1, out=out)
+    assert out.getvalue().startswith('#' * 20 + ' %5d (>= %d) (' % (histogram['a'], histogram['a'] - histogram.errors['a']))
+
+
+@pytest.mark.parametrize(['binning', 'bins', 'expected'], [
+    ('fixed', 3, {Bin(-2, 2): 2, Bin(2, 6): 2, Bin(6, 10): 2}),
+    ('log', 1, {Bin(-2, 1): 1, Bin(1, 10): 5}),
+    ('quantile', 2, {Bin(-2, 2.5): 3, Bin(2.5, 10): 3}),
+])
+def test_numeric_histogram(binning, bins, expected):
+    pytest.importorskip('numpy')
+    numeric = NumericHistogram()
+    numeric.observe_words_from_file(io.StringIO('1 2\n3 foo\n10\n10 -2\n'))
+    assert numeric.invalid_qty == 1
+    histogram = numeric.to_histogram(bins=bins, binning=binning)
+    assert histogram == expected
+    assert list(histogram) == sorted(histogram)
+
+
+def test_numeric_histogram_non_finite():
+    pytest.importorskip('numpy')
+    numeric = NumericHistogram()
+    numeric.observe_words_from_file(io.StringIO('1 2 inf 3\nnan -inf\n'))
+    numeric.observe_values([4, float('nan')])
+    assert numeric.values().tolist() == [1, 2, 3, 4]
+    assert numeric.invalid_qty == 4
+    assert numeric.to_histogram(bins=3) == {Bin(1, 2): 1, Bin(2, 3): 1, Bin(3, 4): 2}
+    with pytest.raises(ValueError):
+        NumericHistogram(column=-1)
+
+
+def test_numeric_histogram_column_and_summary():
+    pytest.importorskip('numpy')
+    numeric = NumericHistogram(column=1)
+    numeric.observe_lines_from_file(io.StringIO('a 1\nb 2\nc\nd 3\ne 4\n'))
+    assert numeric.values().tolist() == [1, 2, 3, 4]
+    assert dict(numeric.summary()) == {
+        'count': 4, 'min': 1, 'mean': 2.5, 'p50': 2.5, 'p90': pytest.approx(3.7),
+        'p99': pytest.approx(3.97), 'p99.9': pytest.approx(3.997), 'max': 4, 'invalid': 1,
+    }
+    out = io.StringIO()
+    numeric.to_histogram(bins=3).ascii_plot(keysort=True, out=out)
+    assert [line.split()[-3:] for line in out.getvalue().splitlines()] == [
+        ['1', '..', '2'], ['2', '..', '3'], ['3', '..', '4'],
+    ]
+
+
+@pytest.mark.parametrize('observe_lines', [False, True])
+@pytest.mark.parametrize('range_size', [3, 10, 1000])
+def test_count_from_sources_parallel(tmp_path, observe_lines, range_size):
+    random.seed(range_size)
+    words = ['foo', 'bar', 'baz', 'bär']
+    lines = [' '.join(random.choice(words) for _ in range(random.randint(0, 3))) for _ in range(100)]
+    path = tmp_path / 'words.txt'
+    path.write_bytes(('\n'.join(lines[:50]) + '\r\n' + '\n'.join(lines[50:])).encode('utf-8'))
+    empty = tmp_path / 'empty.txt'
+    empty.write_text('')
+    sources = [str(path), str(empty), str(path)]
+
+    serial = ObjectHistogram()
+    serial.observe_from_sources(sources + [io.StringIO('qux foo\n')], observe_lines=observe_lines)
+    parallel = count_from_sources_parallel(
+        sources + [io.StringIO('qux foo\n')], observe_lines=observe_lines, jobs=2, range_size=range_size
+    )
+    assert parallel == serial
+    assert list(parallel.items()) == list(serial.items())
+
+
+def test_count_from_sources_parallel_fifo(tmp_path):
+    path = str(tmp_path / 'fifo')
+    os.mkfifo(path)
+
+    def produce():
+        with open(path, 'w') as f:
+            f.write('foo bar foo\n')
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    histogram = count_from_sources_parallel([path], jobs=2)
+    producer.join()
+    assert list(histogram.items()) == [('foo', 2), ('bar', 1)]
+
+
+def test_snapshot(tmp_path):
+    a = ObjectHistogram()
+    a.update(['foo', 'bar', 'foo', '', 'bär\n', 'x\udcff'])
+    b = ObjectHistogram()
+    b.update(['baz', 'foo'])
+    for name, histogram in [('a', a), ('b', b), ('empty', ObjectHistogram())]:
+        with open(str(tmp_path / name), 'wb') as f:
+            histogram.write(f)
+    with open(str(tmp_path / 'a'), 'rb') as f:
+        restored = ObjectHistogram.read(f)
+    assert list(restored.items()) == list(a.items())
+
+    merged = merge_snapshots([str(tmp_path / name) for name in ['a', 'empty', 'b', 'a']])
+    assert list(merged.items()) == [('foo', 5), ('bar', 2), ('', 2), ('bär\n', 2), ('x\udcff', 2), ('baz', 1)]
+
+
+def test_snapshot_errors(tmp_path):
+    with pytest.raises(ValueError, match='Not a histogram snapshot'):
+        ObjectHistogram.read(io.BytesIO(b'foo bar\n'))
+    with pytest.raises(TypeError):
+        ObjectHistogram({Bin(0, 1): 3}).write(io.BytesIO())
+    path = tmp_path / 'words.txt'
+    path.write_text('foo bar\n')
+    with pytest.raises(ValueError, match='words.txt: Not a histogram snapshot'):
+        merge_snapshots([str(path)])
+    path.write_bytes(b'ObjHist\0\x01' + b'\x00' * 8 + b'garbage')
+    with pytest.raises(ValueError, match='Corrupt'):
+        merge_snapshots([str(path)])
+
+
+def test_live_histogram_top():
+    random.seed(7)
+    histogram = LiveHistogram(limit=5)
+    exact = collections.Counter()
+    for i in range(2000):
+        x = int(random.paretovariate(1))
+        histogram.observe(x)
+        exact[x] += 1
+        if i % 100 == 0:
+            assert sorted(c for x, c in histogram.top_items()) == sorted(exact.values())[-5:]
+    histogram.update([1000] * 2000)
+    exact.update([1000] * 2000)
+    assert histogram.top_items()[0] == (1000, 2000)
+    assert sorted(c for x, c in histogram.top_items()) == sorted(exact.values())[-5:]
+
+
+def test_live_histogram_decay():
+    now = [0.0]
+    histogram = LiveHistogram(limit=2, half_life=10, clock=lambda: now[0])
+    histogram.update(['a'] * 8)
+    now[0] = 20.0
+    histogram.update(['b'] * 3)
+    assert histogram.top_items() == [('b', 3), ('a', 2)]
+    now[0] = 100000.0
+    histogram.observe('c')
+    assert histogram.top_items()[0] == ('c', 1)
+    out = io.StringIO()
+    histogram.ascii_plot(limit=1, out=out)
+    assert out.getvalue() == '#' * 20 + '     1 (100.00%) c\n'
+
+
+def test_live_histogram_decay_prunes():
+    now = [0.0]
+    histogram = LiveHistogram(limit=2, half_life=1, clock=lambda: now[0])
+    for i in range(1000):
+        now[0] = i / 10.0
+        histogram.update(['x%d' % i, 'top', 'top'])
+    assert len(histogram) < 200
+    assert histogram.top_items()[0][0] == 'top'
+    assert histogram._total == pytest.approx(sum(histogram.values()))
+
+
+def test_watch_stream_regular_file(tmp_path):
+    path = tmp_path / 'words.txt'
+    path.write_text('foo bar\nfoo\n')
+    histogram = LiveHistogram(limit=2)
+    out = io.StringIO()
+    with open(str(path), 'rb') as f:
+        watch_stream(histogram, f.fileno(), interval=0.01, out=out, clear=False)
+    assert histogram == {'foo': 2, 'bar': 1}
+
+
+def test_watch_stream():
+    read_fd, write_fd = os.pipe()
+
+    def produce():
+        with os.fdopen(write_fd, 'wb') as f:
+            f.write('foo bär\nfoo'.encode('utf-8')[:-1])
+            f.flush()
+            f.write(b'o\nbaz foo')
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    histogram = LiveHistogram(limit=2)
+    out = io.StringIO()
+    watch_stream(histogram, read_fd, interval=0.01, out=out, clear=False)
+    producer.join()
+    os.close(read_fd)
+    assert histogram == {'foo': 3, 'bär': 1, 'baz': 1}
+    assert out.getvalue().split('\n\n')[-1].splitlines()[0] == '#' * 20 + '     3 (60.00%) foo'